@@ -8,6 +8,7 @@ import discord
 from discord.ext.commands import Bot, when_mentioned_or
 
 import config
+import modules.anon_polls
 import modules.captcha_verification
 import modules.commands
 import modules.custom_commands
@@ -47,8 +48,15 @@ class TLDR(Bot):
         self.enabled_modules = getattr(config, "MODULES", {})
         self.enabled_cogs = getattr(config, "COGS", {})
         self.settings_handler = modules.utils.SettingsHandler()
+        self.add_listener(modules.utils.role_index.on_guild_role_create)
+        self.add_listener(modules.utils.role_index.on_guild_role_update)
+        self.add_listener(modules.utils.role_index.on_guild_role_delete)
         self.left_check = asyncio.Event()
         self.logger = modules.utils.get_logger()
+        db.migrate_left_leveling_users()
+        db.ensure_indexes()
+        if getattr(config, "VERIFY_INDEXES_ON_BOOT", False):
+            db.verify_indexes()
         self.command_system = modules.commands.CommandSystem(self)
 
         # Load Cogs
@@ -93,6 +101,11 @@ class TLDR(Bot):
             if self.enabled_modules.get("custom_commands", True)
             else None
         )
+        self.anon_polls = (
+            modules.anon_polls.AnonPolls(self)
+            if self.timers and self.enabled_modules.get("anon_polls", True)
+            else None
+        )
         self.leveling_system = (
             modules.leveling.LevelingSystem(self)
             if self.enabled_modules.get("leveling_system", True)
@@ -152,6 +165,17 @@ class TLDR(Bot):
         self.command_system.initialize_cog(cog)
         super().add_cog(cog)
 
+    async def close(self):
+        """Overwrites the original close method to write buffered data to the database before shutting down."""
+        if self.leveling_system:
+            self.leveling_system.write_buffer.flush()
+        if self.anon_polls:
+            self.anon_polls.flush()
+        if self.watchlist:
+            await self.watchlist.flush()
+
+        await super().close()
+
     async def critical_error(self, error: str):
         """
         For errors which would cause the bot not to function.
@@ -991,6 +991,14 @@ class Admin(Cog):
         args["guild_id"] = ctx.guild.id
         # insert into database
         db.custom_commands.insert(args)
+        # matchers that aren't loaded yet will load the command from the database
+        matcher = (
+            self.bot.custom_commands.matchers.get(ctx.guild.id)
+            if self.bot.custom_commands
+            else None
+        )
+        if matcher is not None:
+            matcher.add(args)
 
         # convert args into string that can be presented to user who created the command
         attributes_str = self.custom_command_args_to_string(args)
@@ -1081,6 +1089,14 @@ class Admin(Cog):
         db.custom_commands.update_one(
             {"guild_id": ctx.guild.id, "name": old_command_name}, {"$set": args}
         )
+        # matchers that aren't loaded yet will load the command from the database
+        matcher = (
+            self.bot.custom_commands.matchers.get(ctx.guild.id)
+            if self.bot.custom_commands
+            else None
+        )
+        if matcher is not None:
+            matcher.edit(old_command_name, {**existing, **args})
 
         # convert args into string that can be presented to user who created the command
         attributes_str = self.custom_command_args_to_string(args, old=existing)
@@ -1116,6 +1132,14 @@ class Admin(Cog):
         db.custom_commands.delete_one(
             {"guild_id": ctx.guild.id, "name": command["name"]}
         )
+        # matchers that aren't loaded yet will load the command from the database
+        matcher = (
+            self.bot.custom_commands.matchers.get(ctx.guild.id)
+            if self.bot.custom_commands
+            else None
+        )
+        if matcher is not None:
+            matcher.remove(command["name"])
 
         return await embed_maker.message(
             ctx,
@@ -172,6 +172,7 @@ class Dev(Cog):
         db.commands.update_one(
             {"command_name": command.name}, {"$set": {"disabled": 1}}
         )
+        db.cache.invalidate("commands", command.name)
         return await embed_maker.message(
             ctx,
             description=f"`{command_name}` has been disabled",
@@ -201,6 +202,7 @@ class Dev(Cog):
         db.commands.update_one(
             {"command_name": command.name}, {"$set": {"disabled": 0}}
         )
+        db.cache.invalidate("commands", command.name)
         command_data["disabled"] = 0
         await embed_maker.message(
             ctx,
@@ -209,6 +211,67 @@ class Dev(Cog):
             send=True,
         )
 
+    @command(
+        help="See how many times the database indexes have been used and which queries scan whole collections",
+        usage="index_usage",
+        examples=["index_usage"],
+        cls=commands.Command,
+    )
+    async def index_usage(self, ctx: Context):
+        usage = db.index_usage()
+        collection_scans = db.verify_indexes()
+
+        description = ""
+        for collection_name, indexes in usage.items():
+            description += f"**{collection_name}**\n"
+            description += "\n".join(
+                f"`{name}`: {ops:,} ops" for name, ops in indexes.items()
+            )
+            description += "\n"
+
+        if collection_scans:
+            description += "\n**Collection scans**\n"
+            description += "\n".join(
+                f"`{collection_name}` {query_filter} sort {sort}"
+                for collection_name, query_filter, sort in collection_scans
+            )
+
+        return await embed_maker.message(
+            ctx,
+            description=description,
+            author={"name": "Index Usage"},
+            send=True,
+        )
+
+    @command(
+        help="See which database queries take up the most time",
+        usage="db_stats (amount)",
+        examples=["db_stats", "db_stats 20"],
+        cls=commands.Command,
+    )
+    async def db_stats(self, ctx: Context, amount: int = 10):
+        if not db.query_stats.enabled:
+            return await embed_maker.error(
+                ctx, "Database instrumentation is disabled in the config"
+            )
+
+        offenders = db.query_stats.top(amount)
+        if not offenders:
+            return await embed_maker.error(ctx, "No queries have been recorded yet")
+
+        description = "\n\n".join(
+            f"**{o['collection']}.{o['operation']}** - {o['count']:,} queries | {o['total_ms']:.0f}ms total\n"
+            f"p50: {o['p50']:.2f}ms | p95: {o['p95']:.2f}ms | p99: {o['p99']:.2f}ms | {o['documents']:,} docs\n"
+            f"Callers: {', '.join(f'`{caller}`' for caller in o['callers'][:3])}"
+            for o in offenders
+        )
+        return await embed_maker.message(
+            ctx,
+            description=description,
+            author={"name": "Database Stats"},
+            send=True,
+        )
+
 
 def setup(bot):
     bot.add_cog(Dev(bot))
@@ -149,6 +149,7 @@ class Events(Cog):
         db.daily_debates.update_one(
             {"guild_id": guild.id}, {"$pull": {"topics": topic_data}}
         )
+        db.cache.invalidate("daily_debates", guild.id)
 
         # change channel topic
         await dd_channel.edit(topic=f"{topic}")
@@ -300,8 +301,11 @@ class Events(Cog):
         message_id = payload.message_id
         user_id = payload.user_id
 
-        # check if message is reaction_menu
-        anon_poll = db.timers.find_one({"extras.message_id": message_id})
+        # check if message is an anonymous poll, reactions on other messages don't query the database
+        if not self.bot.timers or not self.bot.anon_polls:
+            return
+
+        anon_poll = self.bot.timers.get_poll_timer(message_id)
         if not anon_poll:
             return
 
@@ -317,13 +321,14 @@ class Events(Cog):
 
         # poll is message sent to user in dms
         if "main_poll_id" in anon_poll["extras"]:
-            main_poll = db.timers.find_one(
-                {"extras.message_id": anon_poll["extras"]["main_poll_id"]}
-            )
-            if emote not in main_poll["extras"]["options"]:
+            main_poll_id = anon_poll["extras"]["main_poll_id"]
+            main_poll = self.bot.anon_polls.get_poll(main_poll_id)
+            if not main_poll or emote not in main_poll["options"]:
                 return
 
-            main_poll_data = main_poll["extras"]
+            pick_count = main_poll["pick_count"]
+            if self.bot.anon_polls.picked_count(main_poll_id, user.id) >= pick_count:
+                return
 
             # check if user has voted for this option already
             user_pick = emote
@@ -331,9 +336,9 @@ class Events(Cog):
                 b"%a" % config.BOT_TOKEN + b"%a" % user.id + b"%a" % user_pick
             ).hexdigest()
 
-            if (
-                f"{user.id}" in main_poll_data["voted"]
-                and user_pick_hash in main_poll_data["voted"][f"{user.id}"]
+            # count user vote, the vote is recorded before anything is awaited, so concurrent reactions can't race
+            if not self.bot.anon_polls.vote(
+                main_poll_id, user.id, user_pick_hash, emote
             ):
                 embed = discord.Embed(
                     colour=config.EMBED_COLOUR,
@@ -345,21 +350,19 @@ class Events(Cog):
             # inform user of what they picked
             description = f"Your vote has been counted towards {user_pick}"
             # inform user if they have more options to pick
-            pick_count = int(main_poll_data["pick_count"])
-            options_picked_count = (
-                len(main_poll_data["voted"][f"{user.id}"]) + 1
-                if f"{user.id}" in main_poll_data["voted"]
-                else 1
+            options_picked_count = self.bot.anon_polls.picked_count(
+                main_poll_id, user.id
             )
             if options_picked_count < pick_count:
                 description += f"\nYou can pick **{pick_count - options_picked_count}** more options"
             else:
+                # delete temporary poll from database
+                db.timers.delete_one({"_id": anon_poll["_id"]})
+                self.bot.timers.unindex_timer(anon_poll)
                 # delete poll message
                 await self.bot.http.delete_message(
                     channel_id, anon_poll_data["message_id"]
                 )
-                # delete temporary poll from database
-                db.timers.delete_one(anon_poll)
 
             embed = discord.Embed(
                 colour=config.EMBED_COLOUR,
@@ -369,16 +372,6 @@ class Events(Cog):
             inform_message = await user.send(embed=embed, delete_after=10)
             await inform_message.delete(delay=5)
 
-            # count user vote
-            db.timers.update_one(
-                {"extras.message_id": main_poll_data["message_id"]},
-                {
-                    "$inc": {f"extras.results.{emote}": 1},
-                    "$push": {f"extras.voted.{user.id}": user_pick_hash},
-                },
-                upsert=True,
-            )
-
         if not guild_id:
             return
 
@@ -414,10 +407,8 @@ class Events(Cog):
             embed.set_footer(text=f"{guild.name}", icon_url=guild.icon.url)
 
             pick_count = int(anon_poll_data["pick_count"])
-            options_picked_count = (
-                len(anon_poll_data["voted"][f"{member.id}"])
-                if f"{member.id}" in anon_poll_data["voted"]
-                else 0
+            options_picked_count = self.bot.anon_polls.picked_count(
+                message_id, member.id
             )
             if options_picked_count >= pick_count:
                 return
@@ -443,9 +434,11 @@ class Events(Cog):
                 await msg.add_reaction(e)
 
             # check if there is already an active temporary timer
-            temp_timer_data = db.timers.find_one({"extras.main_poll_id": message_id})
+            temp_poll_id = self.bot.timers.dm_polls.get((message_id, member.id))
+            temp_timer_data = self.bot.timers.get_poll_timer(temp_poll_id)
             if temp_timer_data:
-                db.timers.delete_one({"extras.main_poll_id": message_id})
+                db.timers.delete_one({"_id": temp_timer_data["_id"]})
+                self.bot.timers.unindex_timer(temp_timer_data)
                 await self.bot.http.delete_message(
                     temp_timer_data["extras"]["channel_id"],
                     temp_timer_data["extras"]["message_id"],
@@ -492,6 +485,7 @@ class Events(Cog):
                             },
                             {"$set": {f"{branch.name[0]}_role": after.name}},
                         )
+                        leveling_guild.invalidate_role_counts(branch)
 
     @Cog.listener()
     async def on_guild_remove(self, guild: Guild):
@@ -527,16 +521,13 @@ class Events(Cog):
                 {"guild_id": guild_id, "user_id": user_id}
             )
             del left_user["_id"]
+            left_user.pop("expires_at", None)
             db.leveling_users.insert_one(left_user)
 
-            # delete timer
-            db.timers.delete_one(
-                {
-                    "guild_id": guild_id,
-                    "extras.user_id": user_id,
-                    "event": "leveling_data_expires",
-                }
-            )
+            if self.bot.leveling_system:
+                leveling_guild = self.bot.leveling_system.get_guild(guild_id)
+                if leveling_guild:
+                    leveling_guild.index_user(left_user)
 
             if self.bot.leveling_system:
                 leveling_member = await self.bot.leveling_system.get_member(
@@ -553,7 +544,7 @@ class Events(Cog):
                         None,
                     )
                     if user_role:
-                        user_role_index = branch.roles.index(user_role)
+                        user_role_index = branch.role_position(user_role)
                         up_to_role = branch.roles[: user_role_index + 1]
                         for role in up_to_role:
                             await leveling_member.add_role(role)
@@ -563,6 +554,10 @@ class Events(Cog):
         if self.bot.captcha:
             await self.bot.captcha.on_member_leave(member)
 
+        if self.bot.leveling_system:
+            # buffered changes need to be in the database before the data is moved
+            self.bot.leveling_system.write_buffer.flush()
+
         leveling_user = db.leveling_users.find_one(
             {"guild_id": member.guild.id, "user_id": member.id}
         )
@@ -572,13 +567,6 @@ class Events(Cog):
 
         self.bot.leveling_system.transfer_leveling_data(leveling_user)
 
-    @Cog.listener()
-    async def on_leveling_data_expires_timer_over(self, timer: dict):
-        # delete user from left_leveling_users
-        db.left_leveling_users.delete_one(
-            {"guild_id": timer["guild_id"], "user_id": timer["extras"]["user_id"]}
-        )
-
     @Cog.listener()
     async def on_guild_channel_delete(self, channel):
         ticket = db.tickets.find_one(
@@ -628,6 +616,11 @@ class Events(Cog):
             {"guild_id": member.guild.id, "user_id": member.id}
         )
 
+        if self.bot.leveling_system:
+            leveling_guild = self.bot.leveling_system.get_guild(member.guild.id)
+            if leveling_guild:
+                leveling_guild.unindex_user(member.id)
+
 
 def setup(bot):
     bot.add_cog(Events(bot))
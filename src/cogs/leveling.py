@@ -9,7 +9,14 @@ from typing import Optional, Union
 import discord
 from bot import TLDR
 from discord.ext.commands import Cog, Context, command, group
-from modules import commands, database, embed_maker, format_time, leveling
+from modules import (
+    commands,
+    database,
+    embed_maker,
+    format_time,
+    level_curve,
+    leveling,
+)
 from modules.reaction_menus import BookMenu
 from modules.utils import ParseArgs, get_member, get_member_from_string
 
@@ -21,19 +28,19 @@ class Cooldown:
         self.cooldown_in_seconds = cooldown_in_seconds
         self.cooldown_users = {}
 
-    def add_user(self, guild_id: int, user_id: int):
+    def add_user(self, guild_id: int, user_id: int, now: float = None):
         if guild_id not in self.cooldown_users:
             self.cooldown_users[guild_id] = {}
 
-        now = time.time() + self.cooldown_in_seconds
+        now = (now or time.time()) + self.cooldown_in_seconds
         self.cooldown_users[guild_id][user_id] = now
 
-    def user_cooldown(self, guild_id: int, user_id: int) -> int:
+    def user_cooldown(self, guild_id: int, user_id: int, now: float = None) -> int:
         if guild_id not in self.cooldown_users:
             self.cooldown_users[guild_id] = {}
 
+        now = now or time.time()
         if user_id in self.cooldown_users[guild_id]:
-            now = time.time()
             cooldown_time = self.cooldown_users[guild_id][user_id] - now
             if cooldown_time < 0:
                 del self.cooldown_users[guild_id][user_id]
@@ -42,7 +49,7 @@ class Cooldown:
             cooldown_time = 0
 
         if not cooldown_time:
-            self.add_user(guild_id, user_id)
+            self.add_user(guild_id, user_id, now)
 
         return int(cooldown_time)
 
@@ -187,16 +194,8 @@ class Leveling(Cog):
             embed = await embed_maker.message(ctx, author={"name": "Ranks"})
 
             # Looks up how many people have a role
-            count = {
-                role.name: db.leveling_users.count(
-                    {
-                        "guild_id": ctx.guild.id,
-                        f"{branch.name[0]}_role": role.name,
-                        f"{branch.name[0]}p": {"$gt": 0},
-                    }
-                )
-                for role in branch.roles
-            }
+            role_counts = leveling_guild.get_role_counts(branch)
+            count = {role.name: role_counts.get(role.name, 0) for role in branch.roles}
 
             value = ""
             for i, role in enumerate(branch.roles):
@@ -294,6 +293,43 @@ class Leveling(Cog):
         ctx.invoked_subcommand = ""
         return await self.ranks(ctx, branch.name)
 
+    @ranks.command(
+        name="reconcile",
+        help="Recalculate everyone's levels and roles from their points and fix the ones that are wrong, "
+        "add -d to only see what would change",
+        usage="ranks reconcile (-d)",
+        examples=["ranks reconcile", "ranks reconcile -d"],
+        cls=commands.Command,
+        module_dependency=["leveling_system"],
+    )
+    async def ranks_reconcile(self, ctx: Context, *, user_input: str = ""):
+        dry_run = bool(re.findall(r"(?:\s|^)(-d)(?:\s|$)", user_input))
+
+        leveling_guild = self.bot.leveling_system.get_guild(ctx.guild.id)
+        report = await leveling_guild.reconcile_levels(dry_run=dry_run)
+
+        changes_str = "\n".join(
+            f"`{field}`: **{count}**" for field, count in report["changes"].items()
+        )
+        description = (
+            f"Checked **{report['users']}** users, "
+            f"**{report['changed_users']}** "
+            + ("would be changed" if dry_run else "were changed")
+            + (
+                f", **{report['skipped_users']}** were skipped because they gained points"
+                if report.get("skipped_users")
+                else ""
+            )
+            + f"\n\n{changes_str}"
+        )
+
+        return await embed_maker.message(
+            ctx,
+            description=description,
+            author={"name": "Ranks Reconcile" + (" - Dry Run" if dry_run else "")},
+            send=True,
+        )
+
     @group(
         invoke_without_command=True,
         help="See all the perks that a role has to offer",
@@ -611,18 +647,7 @@ class Leveling(Cog):
         points = leveling_member.parliamentary.points
         if not level:
             # points needed until level_up
-            pp_till_next_level = (
-                round(
-                    (5 / 6)
-                    * (user_level + 1)
-                    * (
-                        2 * (user_level + 1) * (user_level + 1)
-                        + 27 * (user_level + 1)
-                        + 91
-                    )
-                )
-                - points
-            )
+            pp_till_next_level = level_curve.total_points(user_level + 1) - points
             avg_msg_needed = math.ceil(pp_till_next_level / 20)
 
             # points needed to rank up
@@ -630,14 +655,7 @@ class Leveling(Cog):
             missing_levels = 6 - user_rank
 
             rank_up_level = user_level + missing_levels
-            pp_needed_rank_up = (
-                round(
-                    (5 / 6)
-                    * rank_up_level
-                    * (2 * rank_up_level * rank_up_level + 27 * rank_up_level + 91)
-                )
-                - points
-            )
+            pp_needed_rank_up = level_curve.total_points(rank_up_level) - points
             avg_msg_rank_up = math.ceil(pp_needed_rank_up / 20)
             description = (
                 f"Messages needed to:\n"
@@ -645,9 +663,7 @@ class Leveling(Cog):
                 f"Rank up: **{avg_msg_rank_up}**"
             )
         else:
-            pp_needed = (
-                round((5 / 6) * level * (2 * level * level + 27 * level + 91)) - points
-            )
+            pp_needed = level_curve.total_points(level) - points
             avg_msg_needed = math.ceil(pp_needed / 20)
             description = (
                 f"Messages needed to reach level `{level}`: **{avg_msg_needed}**"
@@ -666,10 +682,10 @@ class Leveling(Cog):
         your_pos: bool = False,
     ):
         lb_str = ""
-        for i, leveling_user in enumerate(sorted_users):
+        for i, (user_id, _) in enumerate(sorted_users):
 
             leveling_member = await self.bot.leveling_system.get_member(
-                ctx.guild.id, leveling_user["user_id"]
+                ctx.guild.id, user_id
             )
             addition = 0 if your_pos else 1
 
@@ -771,13 +787,9 @@ class Leveling(Cog):
             branch = branch_switch.get(branch[0], leveling_routes.parliamentary)
 
         key = f"{branch.name[0]}p"
-        # get list of users sorted by points who have more than 0 points
-        sorted_users = [
-            u
-            for u in db.leveling_users.find(
-                {"guild_id": ctx.guild.id, key: {"$gt": 0}}
-            ).sort(key, -1)
-        ]
+        # get list of (user_id, points) sorted by points of users who have more than 0 points
+        leaderboard = leveling_guild.get_leaderboard(key)
+        sorted_users = leaderboard.users
 
         page_size_limit = 10
 
@@ -789,12 +801,7 @@ class Leveling(Cog):
         if page > max_page_num:
             return await embed_maker.error(ctx, "Exceeded maximum page number")
 
-        leveling_user = db.get_leveling_user(ctx.guild.id, ctx.author.id)
-        user_index = (
-            sorted_users.index(leveling_user)
-            if leveling_user in sorted_users
-            else len(sorted_users)
-        )
+        user_index = leaderboard.position(ctx.author.id)
 
         # create function with all the needed values except page, so the function can be called with only the page kwarg
         page_constructor = functools.partial(
@@ -843,16 +850,7 @@ class Leveling(Cog):
         progress = leveling_member.percent_till_next_level(user_branch)
 
         if verbose:
-            points_till_next_level = round(
-                5
-                / 6
-                * (user_branch.level + 1)
-                * (
-                    2 * (user_branch.level + 1) * (user_branch.level + 1)
-                    + 27 * (user_branch.level + 1)
-                    + 91
-                )
-            )
+            points_till_next_level = level_curve.total_points(user_branch.level + 1)
             cooldown_object = self.pp_cooldown
 
             cooldown = f"{cooldown_object.user_cooldown(leveling_member.guild.id, leveling_member.id)} seconds"
@@ -1038,14 +1036,29 @@ class Leveling(Cog):
                     ctx, description=msg, colour=colour, send=True
                 )
 
-    async def process_message(self, message: discord.Message):
-        author = message.author
-        guild = message.guild
+    async def process_message(
+        self, guild_id: int, author_id: int, channel_id: int, timestamp: float = None
+    ):
+        channel = self.bot.get_channel(channel_id)
+        leveling_guild = self.bot.leveling_system.get_guild(guild_id)
+        if channel is None or leveling_guild is None:
+            return
 
-        leveling_member = await self.bot.leveling_system.get_member(guild.id, author.id)
+        # check cooldowns first, so members on cooldown don't need to be fetched
+        # cooldowns are compared against when the message was sent, not when it's processed
+        give_pp = not self.pp_cooldown.user_cooldown(guild_id, author_id, timestamp)
+        give_hp = leveling_guild.is_honours_channel(channel_id) and (
+            not self.hp_cooldown.user_cooldown(guild_id, author_id, timestamp)
+        )
+        if not give_pp and not give_hp:
+            return
+
+        leveling_member = await leveling_guild.get_member(author_id)
+        if leveling_member is None:
+            return
 
         # level parliamentary route
-        if not self.pp_cooldown.user_cooldown(guild.id, author.id):
+        if give_pp:
             pp_add = randint(15, 25)
             await leveling_member.add_points("parliamentary", pp_add)
 
@@ -1055,14 +1068,11 @@ class Leveling(Cog):
             if levels_up:
                 current_role = await current_role.get_guild_role()
                 await leveling_member.level_up_message(
-                    message, leveling_member.parliamentary, current_role, roles_up
+                    channel, leveling_member.parliamentary, current_role, roles_up
                 )
 
         # level honours route
-        if (
-            message.channel.id in leveling_member.guild.honours_channels
-            and not self.hp_cooldown.user_cooldown(guild.id, author.id)
-        ):
+        if give_hp:
             hp_add = randint(7, 12)
             await leveling_member.add_points("honours", hp_add)
 
@@ -1072,7 +1082,7 @@ class Leveling(Cog):
             if levels_up:
                 current_role = await current_role.get_guild_role()
                 await leveling_member.level_up_message(
-                    message, leveling_member.honours, current_role, roles_up
+                    channel, leveling_member.honours, current_role, roles_up
                 )
 
 
@@ -1504,6 +1504,7 @@ class Mod(Cog):
     )
     async def dailydebates_disable(self, ctx: Context):
         db.daily_debates.update_one({"guild_id": ctx.guild.id}, {"$set": {"time": 0}})
+        db.cache.invalidate("daily_debates", ctx.guild.id)
 
         # cancel timer if active
         daily_debate_timer = db.timers.find_one(
@@ -1570,6 +1571,7 @@ class Mod(Cog):
         db.daily_debates.update_one(
             {"guild_id": ctx.guild.id}, {"$set": {f"topics.{index - 1}": topic_obj}}
         )
+        db.cache.invalidate("daily_debates", ctx.guild.id)
         options_str = "\n".join(
             [f"{emote}: {option}" for emote, option in emote_options.items()]
         )
@@ -1618,6 +1620,7 @@ class Mod(Cog):
         db.daily_debates.update_one(
             {"guild_id": ctx.guild.id}, {"$push": {"topics": topic_obj}}
         )
+        db.cache.invalidate("daily_debates", ctx.guild.id)
         daily_debate_data = db.daily_debates.find_one({"guild_id": ctx.guild.id})
         await embed_maker.message(
             ctx,
@@ -1677,6 +1680,7 @@ class Mod(Cog):
             {"guild_id": ctx.guild.id},
             {"$push": {"topics": {"$each": [topic_obj], "$position": 0}}},
         )
+        db.cache.invalidate("daily_debates", ctx.guild.id)
 
         daily_debate_data = db.daily_debates.find_one({"guild_id": ctx.guild.id})
         await embed_maker.message(
@@ -1725,6 +1729,7 @@ class Mod(Cog):
         db.daily_debates.update_one(
             {"guild_id": ctx.guild.id}, {"$pull": {"topics": topic_to_delete}}
         )
+        db.cache.invalidate("daily_debates", ctx.guild.id)
 
         return await embed_maker.message(
             ctx,
@@ -1768,6 +1773,7 @@ class Mod(Cog):
         db.daily_debates.update_one(
             {"guild_id": ctx.guild.id}, {"$set": {"time": time_str}}
         )
+        db.cache.invalidate("daily_debates", ctx.guild.id)
         await embed_maker.message(
             ctx,
             description=f"Daily debates will now be announced every day at {time_str}",
@@ -1801,6 +1807,7 @@ class Mod(Cog):
         db.daily_debates.update_one(
             {"guild_id": ctx.guild.id}, {"$set": {"channel_id": channel.id}}
         )
+        db.cache.invalidate("daily_debates", ctx.guild.id)
         return await embed_maker.message(
             ctx,
             description=f"Daily debates will now be announced every day at <#{channel.id}>",
@@ -1825,6 +1832,7 @@ class Mod(Cog):
             db.daily_debates.update_one(
                 {"guild_id": ctx.guild.id}, {"$set": {"role_id": 0}}
             )
+            db.cache.invalidate("daily_debates", ctx.guild.id)
             return await embed_maker.message(
                 ctx, description="daily debates role has been disabled", send=True
             )
@@ -1834,6 +1842,7 @@ class Mod(Cog):
         db.daily_debates.update_one(
             {"guild_id": ctx.guild.id}, {"$set": {"role_id": role.id}}
         )
+        db.cache.invalidate("daily_debates", ctx.guild.id)
         return await embed_maker.message(
             ctx,
             description=f"Daily debates will now be announced every day to <@&{role.id}>",
@@ -1858,6 +1867,7 @@ class Mod(Cog):
             db.daily_debates.update_one(
                 {"guild_id": ctx.guild.id}, {"$set": {"role_id": 0}}
             )
+            db.cache.invalidate("daily_debates", ctx.guild.id)
             return await embed_maker.message(
                 ctx,
                 description="daily debates poll channel has been disabled",
@@ -1867,6 +1877,7 @@ class Mod(Cog):
         db.daily_debates.update_one(
             {"guild_id": ctx.guild.id}, {"$set": {"poll_channel_id": channel.id}}
         )
+        db.cache.invalidate("daily_debates", ctx.guild.id)
         return await embed_maker.message(
             ctx,
             description=f"Daily debate polls will now be sent every day to <#{channel.id}>",
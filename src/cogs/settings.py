@@ -61,6 +61,7 @@ class Settings(Cog):
             db.guild_settings.update_one(
                 {"guild_id": ctx.guild.id}, {"$set": {"mute_role_id": role.id}}
             )
+            db.cache.invalidate("guild_settings", ctx.guild.id)
             await embed_maker.message(
                 ctx,
                 description=f"Mute role has been set to <@&{role.id}>",
@@ -303,6 +303,10 @@ class Utility(Cog):
 
     @Cog.listener()
     async def on_anon_poll_timer_over(self, timer):
+        # the timer is claimed, so buffered votes aren't flushed to it and are added to it here
+        if self.bot.anon_polls:
+            self.bot.anon_polls.apply(timer["extras"])
+
         message_id = timer["extras"]["message_id"]
         channel_id = timer["extras"]["channel_id"]
         guild_id = timer["guild_id"]
@@ -370,6 +374,9 @@ class Utility(Cog):
         # check if poll passed true expire
         if expired:
             # delete poll from db
+            if self.bot.anon_polls:
+                self.bot.anon_polls.forget(message.id)
+
             await message.clear_reactions()
 
             # delete any remaining temp polls in dms
@@ -377,8 +384,9 @@ class Utility(Cog):
                 d for d in db.timers.find({"extras.main_poll_id": message.id})
             ]
             if temp_polls:
-                db.timers.delete_many({"main_poll_id": message.id})
+                db.timers.delete_many({"extras.main_poll_id": message.id})
                 for poll in temp_polls:
+                    self.bot.timers.unindex_timer(poll)
                     await self.bot.http.delete_message(
                         poll["extras"]["channel_id"], poll["extras"]["message_id"]
                     )
@@ -390,6 +398,10 @@ class Utility(Cog):
 
         # run poll timer again if needed
         elif update_interval:
+            # add votes made while the message was being updated
+            if self.bot.anon_polls:
+                self.bot.anon_polls.apply(timer["extras"])
+
             expires = round(time.time()) + round(update_interval)
             return self.bot.timers.create(
                 guild_id=timer["guild_id"],
@@ -33,7 +33,31 @@ MODULES = {
     # "ukparl_module": False,
     # "watchlist": False,
     # "threading": False,
+    # "anon_polls": False,
 }
 COGS = {}
+# eviction policy of cached leveling members, max_size members and ttl in seconds
+LEVELING_MEMBER_CACHE = {
+    "max_size": 5000,
+    "ttl": 3600,
+}
+# read-through cache of rarely changing documents, ttls in seconds per collection
+DATABASE_CACHE = {
+    "enabled": True,
+    "ttls": {
+        "guild_settings": 600,
+        "commands": 600,
+        "leveling_data": 300,
+        "daily_debates": 300,
+    },
+}
+# records every database query for the db_stats dev command, queries slower than slow_query_ms are logged
+DATABASE_INSTRUMENTATION = {
+    "enabled": False,
+    "slow_query_ms": 100,
+    "history_size": 5000,
+}
+# explain the hot queries on boot and log the ones that scan whole collections, the index_usage dev command does the same
+VERIFY_INDEXES_ON_BOOT = False
 
 # test
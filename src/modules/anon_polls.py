@@ -0,0 +1,171 @@
+from typing import Optional
+
+from modules import database, timers
+
+db = database.get_connection()
+
+
+class AnonPolls:
+    """
+    Buffers the votes of anonymous polls in memory.
+
+    Votes are checked and recorded without awaiting anything in between, so concurrent reactions can't race each other,
+    and are written to the poll timers with $set and $inc every few seconds and when the poll timer is over.
+
+    Attributes
+    ---------------
+    bot: :class:`bot.TLDR`
+        The discord bot.
+    polls: :class:`dict`
+        Options, pick_count and voted of polls, keyed by the poll message id.
+        voted is a dict of user id to the hashes of the options the user has picked.
+    pending_results: :class:`dict`
+        Votes that haven't been written to the database, {poll message id: {emote: votes}}.
+    pending_voters: :class:`dict`
+        Sets of the ids of users whose picks haven't been written to the database, keyed by the poll message id.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.polls = {}
+        self.pending_results = {}
+        self.pending_voters = {}
+        self.bot.add_listener(self.on_ready, "on_ready")
+        self.bot.logger.info("AnonPolls module has been initiated")
+
+    async def on_ready(self):
+        self.flush_votes.start()
+
+    @timers.loop(seconds=5)
+    async def flush_votes(self):
+        """Periodically writes buffered votes to the database."""
+        self.flush()
+
+    def get_poll(self, message_id: int) -> Optional[dict]:
+        """
+        Get the options, pick_count and voted of a poll, loading them from the poll timer the first time.
+
+        Parameters
+        ----------------
+        message_id: :class:`int`
+            ID of the poll message.
+
+        Returns
+        -------
+        Optional[:class:`dict`]
+            The poll or None if the message isn't an active poll.
+        """
+        if message_id not in self.polls:
+            timer = self.bot.timers.get_poll_timer(message_id)
+            if not timer:
+                return None
+
+            extras = timer["extras"]
+            self.polls[message_id] = {
+                "options": extras["options"],
+                "pick_count": int(extras["pick_count"]),
+                "voted": extras["voted"],
+            }
+
+        return self.polls[message_id]
+
+    def picked_count(self, message_id: int, user_id: int) -> int:
+        """Get how many options a user has picked in a poll."""
+        poll = self.get_poll(message_id)
+        if not poll:
+            return 0
+
+        return len(poll["voted"].get(str(user_id), []))
+
+    def vote(self, message_id: int, user_id: int, pick_hash: str, emote: str) -> bool:
+        """
+        Record a vote.
+
+        Parameters
+        ----------------
+        message_id: :class:`int`
+            ID of the poll message.
+        user_id: :class:`int`
+            ID of the user who voted.
+        pick_hash: :class:`str`
+            Hash of the user and the option they picked.
+        emote: :class:`str`
+            Emote of the option.
+
+        Returns
+        -------
+        :class:`bool`
+            False if the user has already voted for the option or has no picks left, True otherwise.
+        """
+        poll = self.get_poll(message_id)
+        if not poll:
+            return False
+
+        user_picks = poll["voted"].setdefault(str(user_id), [])
+        if pick_hash in user_picks or len(user_picks) >= poll["pick_count"]:
+            return False
+
+        user_picks.append(pick_hash)
+        results = self.pending_results.setdefault(message_id, {})
+        results[emote] = results.get(emote, 0) + 1
+        self.pending_voters.setdefault(message_id, set()).add(str(user_id))
+        return True
+
+    def flush(self):
+        """
+        Write buffered votes to the poll timers, votes of polls whose timer is being recreated are kept.
+        Claimed timers are skipped, their event is running and they will be deleted once it's done.
+        """
+        for message_id in list(self.pending_results):
+            results = self.pending_results[message_id]
+            voted = self.polls[message_id]["voted"]
+            result = db.timers.update_one(
+                {
+                    "event": "anon_poll",
+                    "extras.message_id": message_id,
+                    "claimed_by": {"$exists": False},
+                },
+                {
+                    "$inc": {f"extras.results.{e}": n for e, n in results.items()},
+                    "$set": {
+                        f"extras.voted.{user_id}": voted[user_id]
+                        for user_id in self.pending_voters[message_id]
+                    },
+                },
+            )
+            if result.matched_count:
+                del self.pending_results[message_id]
+                del self.pending_voters[message_id]
+
+    def apply(self, extras: dict) -> dict:
+        """
+        Add the buffered votes of a poll to the extras of its timer, used when the timer is over,
+        since the timer is claimed and :func:`flush` no longer writes to it.
+        Should be called again right before the timer is recreated, to add votes made in the meantime.
+
+        Parameters
+        ----------------
+        extras: :class:`dict`
+            Extras of the anon_poll timer.
+
+        Returns
+        -------
+        :class:`dict`
+            The extras.
+        """
+        message_id = extras["message_id"]
+        results = self.pending_results.pop(message_id, {})
+        self.pending_voters.pop(message_id, None)
+        for emote, votes in results.items():
+            extras["results"][emote] = extras["results"].get(emote, 0) + votes
+
+        if message_id in self.polls:
+            extras["voted"] = self.polls[message_id]["voted"]
+
+        return extras
+
+    def forget(self, message_id: int):
+        """Remove a poll that has ended from memory."""
+        self.polls.pop(message_id, None)
+        self.pending_results.pop(message_id, None)
+        self.pending_voters.pop(message_id, None)
@@ -1,15 +1,19 @@
 import copy
 import re
-from typing import Optional
+from typing import Optional, Tuple
 
 import config
 import discord
+import regex
+from cachetools import LRUCache
 from discord.ext.commands import (Context, MemberConverter, RoleConverter,
                                   TextChannelConverter)
 
 from modules import database
 
 db = database.get_connection()
+# matches numbered backreferences, references in conditionals and global inline flags in regex patterns
+uncombinable_pattern = re.compile(r"\\[1-9]|\(\?\(|\(\?[aiLmsux-]+\)")
 
 
 class User:
@@ -164,6 +168,173 @@ class Role:
             raise Exception("Accessing forbidden fruit")
 
 
+class CommandMatcher:
+    """
+    Matches messages against the custom commands of a guild.
+
+    The names of the commands are compiled once and combined into a single alternation, so a message that doesn't match
+    any command is rejected with one regex scan.
+
+    Attributes
+    ---------------
+    commands: :class:`list`
+        (compiled name, custom command) of the guild's custom commands, in the order they were added.
+    combined: Optional[:class:`re.Pattern`]
+        All the names combined into one pattern, each in a named group, None if they couldn't be combined.
+    """
+
+    def __init__(self, custom_commands: list):
+        self.commands = []
+        for custom_command in custom_commands:
+            self.compile(custom_command)
+
+        self.combine()
+
+    def compile(self, custom_command: dict):
+        """Compile the name of a custom command and add it to :attr:`commands`, invalid names are ignored."""
+        try:
+            pattern = re.compile(custom_command["name"])
+        except re.error:
+            return
+
+        self.commands.append((pattern, custom_command))
+
+    def combine(self):
+        """Rebuild :attr:`combined` from :attr:`commands`."""
+        self.combined = None
+        # numbered references and global flags would change meaning in the combined pattern,
+        # names that use them are matched one by one
+        if not self.commands or any(
+            uncombinable_pattern.search(p.pattern) for p, _ in self.commands
+        ):
+            return
+
+        try:
+            self.combined = re.compile(
+                "|".join(
+                    f"(?P<_cc{i}>{pattern.pattern})"
+                    for i, (pattern, _) in enumerate(self.commands)
+                )
+            )
+        except re.error:
+            pass
+
+    def add(self, custom_command: dict):
+        """Add a custom command."""
+        self.compile(custom_command)
+        self.combine()
+
+    def remove(self, name: str):
+        """Remove a custom command by its name."""
+        self.commands = [(p, cc) for p, cc in self.commands if cc["name"] != name]
+        self.combine()
+
+    def edit(self, name: str, custom_command: dict):
+        """Replace a custom command, keeping its place in the order."""
+        for i, (_, cc) in enumerate(self.commands):
+            if cc["name"] == name:
+                try:
+                    self.commands[i] = (
+                        re.compile(custom_command["name"]),
+                        custom_command,
+                    )
+                except re.error:
+                    del self.commands[i]
+                break
+        else:
+            self.compile(custom_command)
+
+        self.combine()
+
+    def match(self, content: str) -> Optional[Tuple[re.Pattern, dict]]:
+        """
+        Find the first custom command whose name matches the content.
+
+        Parameters
+        ----------------
+        content: :class:`str`
+            Content of a message.
+
+        Returns
+        -------
+        Optional[Tuple[:class:`re.Pattern`, :class:`dict`]]
+            The compiled name and the custom command, if one matched.
+        """
+        candidates = self.commands
+        if self.combined is not None:
+            match = self.combined.search(content)
+            if match is None:
+                return None
+
+            # the command that matched first in the message isn't necessarily the first command that matches,
+            # so the commands before it are still checked
+            matched_index = next(
+                int(name[3:])
+                for name, value in match.groupdict().items()
+                if name.startswith("_cc") and value is not None
+            )
+            candidates = self.commands[: matched_index + 1]
+
+        return next(
+            ((p, cc) for p, cc in candidates if p.search(content) is not None), None
+        )
+
+
+class ResponseTemplate:
+    """
+    A custom command response compiled into a render plan.
+
+    Attributes
+    ---------------
+    segments: :class:`list`
+        The parts of the response in order: ("text", literal text), ("group", group number of a $gN variable)
+        or ("variable", text of a {variable} without the braces).
+    """
+
+    # variables can't contain braces or new lines, so they're found in a single linear pass
+    variable_pattern = re.compile(r"{([^{}\n]+)}")
+    group_pattern = re.compile(r"\$g(\d+)")
+
+    def __init__(self, response: str):
+        self.segments = []
+        position = 0
+        for match in self.variable_pattern.finditer(response):
+            self.add_text(response[position : match.start()])
+            self.segments.append(("variable", match.group(1)))
+            position = match.end()
+
+        self.add_text(response[position:])
+
+    def add_text(self, text: str):
+        """Add literal text to :attr:`segments`, splitting out $gN variables."""
+        position = 0
+        for match in self.group_pattern.finditer(text):
+            if match.start() > position:
+                self.segments.append(("text", text[position : match.start()]))
+            self.segments.append(("group", int(match.group(1))))
+            position = match.end()
+
+        if position < len(text):
+            self.segments.append(("text", text[position:]))
+
+    @staticmethod
+    def group(number: int, groups: list) -> str:
+        """Get the value of a $gN variable, variables without a group are left as they are."""
+        if 0 < number <= len(groups):
+            return groups[number - 1]
+
+        return f"$g{number}"
+
+    def replace_groups(self, variable: str, groups: list) -> str:
+        """Replace $gN variables inside of a variable, so groups can be used as identifiers like {%$g1.name}."""
+        if "$g" not in variable:
+            return variable
+
+        return self.group_pattern.sub(
+            lambda match: self.group(int(match.group(1)), groups), variable
+        )
+
+
 class CustomCommands:
     """
     Handler of custom commands.
@@ -172,14 +343,38 @@ class CustomCommands:
     ---------------
     bot: :class:`bot.TLDR`
         Bot instance.
+    matchers: :class:`dict`
+        :class:`CommandMatcher` of guilds, keyed by guild id, loaded when the first message of a guild is matched.
+    templates: :class:`cachetools.LRUCache`
+        Compiled :class:`ResponseTemplate` of the most recently used responses, keyed by the response.
     """
 
+    # seconds the name of a custom command can take to match when getting its groups
+    regex_timeout = 0.1
+    # max number of compiled responses kept in templates
+    max_templates = 1000
+    # prefixes of variables that refer to a specific user, channel or role, with their converter and class
+    variable_converters = {
+        "%": (MemberConverter, User),
+        "*": (TextChannelConverter, Channel),
+        "&": (RoleConverter, Role),
+    }
+
     def __init__(self, bot):
         self.bot = bot
+        self.matchers = {}
+        self.templates = LRUCache(maxsize=self.max_templates)
         self.bot.logger.info("CustomCommands module has been initiated")
 
-    @staticmethod
-    def match_message(message: discord.Message) -> Optional[dict]:
+    def get_matcher(self, guild_id: int) -> CommandMatcher:
+        """Get the :class:`CommandMatcher` of a guild, loading the guild's custom commands the first time."""
+        if guild_id not in self.matchers:
+            custom_commands = db.custom_commands.find({"guild_id": guild_id})
+            self.matchers[guild_id] = CommandMatcher(list(custom_commands))
+
+        return self.matchers[guild_id]
+
+    def match_message(self, message: discord.Message) -> Optional[dict]:
         """
         Matches discord message against custom commands.
 
@@ -193,11 +388,9 @@ class CustomCommands:
         :class:`dict`
             A custom command if one is found.
         """
-        # using aggregation match custom command "name" value against message content
-        custom_commands = db.custom_commands.find({"guild_id": message.guild.id})
-        for cc in custom_commands:
-            if re.findall(cc["name"], message.content):
-                return cc
+        match = self.get_matcher(message.guild.id).match(message.content)
+        if match:
+            return match[1]
 
     async def can_use(self, ctx: Context, command: dict):
         """
@@ -236,6 +429,41 @@ class CustomCommands:
 
         return can_use
 
+    def get_template(self, response: str) -> ResponseTemplate:
+        """Get the compiled :class:`ResponseTemplate` of a response, compiling it the first time."""
+        if response not in self.templates:
+            self.templates[response] = ResponseTemplate(response)
+
+        return self.templates[response]
+
+    def find_groups(self, name: str, content: str) -> list:
+        """
+        Get the groups the name of a custom command matches in a message, used for $gN variables.
+        The regex is evaluated with a timeout, so a pathological name can't stall the bot.
+
+        Parameters
+        ----------------
+        name: :class:`str`
+            Name of the custom command.
+        content: :class:`str`
+            Content of the message.
+
+        Returns
+        -------
+        :class:`list`
+            The groups of the first match, or the full matches if the name has no groups.
+        """
+        try:
+            groups = regex.findall(name, content, timeout=self.regex_timeout)
+        except (TimeoutError, regex.error) as e:
+            self.bot.logger.exception(f"Custom command name `{name}` failed: {e}")
+            return []
+
+        if not groups:
+            return []
+
+        return list(groups[0]) if type(groups[0]) == tuple else groups
+
     async def get_response(self, ctx: Context, command: dict) -> Optional[str]:
         """
         Replaces all the variables and groups in command response with relevant data.
@@ -256,7 +484,10 @@ class CustomCommands:
         if not response:
             return
 
-        # define default values
+        template = self.get_template(response)
+        groups = self.find_groups(command["name"], ctx.message.content)
+
+        # define default values, users, channels and roles used by variables are added to it when they're resolved
         values = {
             "user": User(ctx.author),
             "guild": Guild(ctx.guild),
@@ -264,53 +495,58 @@ class CustomCommands:
             "message": Message(ctx.message),
         }
 
-        # replace $gN type variables with values
-        groups = re.findall(command["name"], ctx.message.content)
-        for i, group in enumerate(groups[0] if type(groups[0]) == tuple else groups):
-            response = response.replace(f"$g{i + 1}", group)
-
-        # get list of variables with regex
-        variables_list = re.findall(r"({([%*&>]?(?:.+\s?)+(?:\..+)?)})", response)
-        # loop over found variables, done in a loop, so when an error occurs, the invalid variable can be ignored
-        for variable, value in variables_list:
-            try:
-                # if specific user is called for in variable, add the user to values dict
-                if value.startswith("%"):
-                    user_identifier = value.split(".")[0]
-                    if user_identifier not in values:
-                        user = await MemberConverter().convert(ctx, user_identifier[1:])
-                        values[user_identifier] = User(user)
-                # if specific channel is called for in variable, add the channel to values dict
-                elif value.startswith("*"):
-                    channel_identifier = value.split(".")[0]
-                    if channel_identifier not in values:
-                        channel = await TextChannelConverter().convert(
-                            ctx, channel_identifier[1:]
-                        )
-                        values[channel_identifier] = Channel(channel)
-                # if specific role is called for in variable, add the role to values dict
-                elif value.startswith("&"):
-                    role_identifier = value.split(".")[0]
-                    if role_identifier not in values:
-                        role = await RoleConverter().convert(ctx, role_identifier[1:])
-                        values[role_identifier] = Role(role)
-                # if variable is for command, run that command
-                elif value.startswith(">"):
-                    command_name = value.split(" ")[0]
-                    if command_name not in values:
-                        # this is kind of a bad way of doing this, but fuck it
-                        msg = copy.copy(ctx.message)
-                        msg.channel = ctx.channel
-                        msg.author = ctx.author
-                        msg.content = config.PREFIX + value[1:]
-                        new_ctx = await self.bot.get_context(msg, cls=type(ctx))
-                        await self.bot.invoke(new_ctx)
-                        response = response.replace(f"{variable}", "")
-                        continue
-
-                # replace variable in response with new value
-                response = response.replace(variable, variable.format(**values))
-            except Exception as e:
-                self.bot.logger.exception(str(e))
-
-        return response
+        parts = []
+        for kind, value in template.segments:
+            if kind == "text":
+                parts.append(value)
+            elif kind == "group":
+                parts.append(template.group(value, groups))
+            else:
+                variable = template.replace_groups(value, groups)
+                parts.append(await self.render_variable(ctx, variable, values))
+
+        return "".join(parts)
+
+    async def render_variable(self, ctx: Context, variable: str, values: dict) -> str:
+        """
+        Get the value of a variable, done one variable at a time, so when an error occurs, the invalid variable can be
+        left as it is.
+
+        Parameters
+        ----------------
+        ctx: :class:`discord.ext.commands.Context`
+            Context
+        variable: :class:`str`
+            The variable without the surrounding braces.
+        values: :class:`dict`
+            Values that have already been resolved during this invocation.
+
+        Returns
+        -------
+        :class:`str`
+            The value of the variable.
+        """
+        try:
+            # if variable is for command, run that command
+            if variable.startswith(">"):
+                # this is kind of a bad way of doing this, but fuck it
+                msg = copy.copy(ctx.message)
+                msg.channel = ctx.channel
+                msg.author = ctx.author
+                msg.content = config.PREFIX + variable[1:]
+                new_ctx = await self.bot.get_context(msg, cls=type(ctx))
+                await self.bot.invoke(new_ctx)
+                return ""
+
+            # if specific user, channel or role is called for in variable, add it to values dict
+            if variable[:1] in self.variable_converters:
+                identifier = variable.split(".")[0]
+                if identifier not in values:
+                    converter, cls = self.variable_converters[variable[0]]
+                    value = await converter().convert(ctx, identifier[1:])
+                    values[identifier] = cls(value)
+
+            return f"{{{variable}}}".format(**values)
+        except Exception as e:
+            self.bot.logger.exception(str(e))
+            return f"{{{variable}}}"
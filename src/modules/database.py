@@ -1,13 +1,325 @@
-from typing import Union
+import asyncio
+import copy
+import datetime
+import functools
+import inspect
+import logging
+import math
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Union
 
 import config
 import pymongo
 from bson import ObjectId
+from pymongo import IndexModel, monitoring
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
 
 from ukparliament.bills_tracker import FeedUpdate
 from ukparliament.divisions_tracker import CommonsDivision, LordsDivision
 
 active_connection = None
+active_async_connection = None
+logger = logging.getLogger("TLDR")
+# how long the leveling data of members who have left their guild is kept for
+left_data_lifetime = datetime.timedelta(days=30)
+
+
+class ReadCache:
+    """
+    Read-through cache for rarely changing documents, keyed by collection name and document key.
+    Entries expire after the ttl of their collection and are removed early with :func:`invalidate`
+    whenever the document is written to.
+
+    Attributes
+    ---------------
+    enabled: :class:`bool`
+        When False, every read bypasses the cache and goes to the database.
+    ttls: :class:`dict`
+        Seconds entries of a collection are kept for, keyed by collection name.
+    entries: :class:`dict`
+        Cached documents, entries[collection][key] = (expires, document).
+    hits: :class:`dict`
+        Number of reads served from the cache per collection.
+    misses: :class:`dict`
+        Number of reads that went to the database per collection.
+    lock: :class:`threading.Lock`
+        Lock held while the cache is read or changed, the cache is used from the threads of :class:`AsyncConnection`.
+    """
+
+    default_ttls = {
+        "guild_settings": 600,
+        "commands": 600,
+        "leveling_data": 300,
+        "daily_debates": 300,
+    }
+
+    def __init__(self, *, enabled: bool = True, ttls: dict = None):
+        self.enabled = enabled
+        self.ttls = {**self.default_ttls, **(ttls or {})}
+        self.entries = {}
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    def get(self, collection: str, key):
+        """
+        Get a cached document.
+
+        Parameters
+        ----------------
+        collection: :class:`str`
+            Name of the collection.
+        key:
+            Key of the document.
+
+        Returns
+        -------
+        Optional[:class:`dict`]
+            Copy of the document or None if it isn't cached, has expired or the cache is disabled.
+        """
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(collection, {}).get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses[collection] = self.misses.get(collection, 0) + 1
+                return None
+
+            self.hits[collection] = self.hits.get(collection, 0) + 1
+
+        return copy.deepcopy(entry[1])
+
+    def set(self, collection: str, key, document: dict):
+        """Cache a copy of a document for the ttl of its collection."""
+        if not self.enabled:
+            return
+
+        expires = time.monotonic() + self.ttls.get(collection, 300)
+        document = copy.deepcopy(document)
+        with self.lock:
+            self.entries.setdefault(collection, {})[key] = (expires, document)
+
+    def invalidate(self, collection: str, key=None):
+        """
+        Remove a document from the cache, should be called after every write to a cached document.
+
+        Parameters
+        ----------------
+        collection: :class:`str`
+            Name of the collection.
+        key:
+            Key of the document, if not given, the whole collection is removed from the cache.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.pop(collection, None)
+            else:
+                self.entries.get(collection, {}).pop(key, None)
+
+    def clear(self):
+        """Remove everything from the cache."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Get cache statistics.
+
+        Returns
+        -------
+        :class:`dict`
+            Hits, misses, hit rate and cached document count per collection.
+        """
+        with self.lock:
+            collections = set(self.hits) | set(self.misses) | set(self.entries)
+            stats = {}
+            for collection in collections:
+                hits = self.hits.get(collection, 0)
+                misses = self.misses.get(collection, 0)
+                stats[collection] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0,
+                    "size": len(self.entries.get(collection, {})),
+                }
+
+        return stats
+
+
+class QueryStats(monitoring.CommandListener):
+    """
+    Pymongo command listener that records every database query. It's only registered to the client when enabled,
+    so when disabled it adds no overhead.
+
+    Attributes
+    ---------------
+    enabled: :class:`bool`
+        If the listener is registered to the client.
+    slow_query_ms: :class:`float`
+        Queries that take longer than this many milliseconds are logged.
+    history: :class:`collections.deque`
+        Ring buffer of the latest queries, (collection, operation, duration in ms, documents, caller).
+    counts: :class:`dict`
+        Number of queries per (collection, operation) since the bot started.
+    started_queries: :class:`dict`
+        (collection, caller) of queries that haven't finished yet, keyed by connection id and request id.
+    """
+
+    # modules whose frames are skipped when looking for the module that made the query
+    internal_modules = (
+        "pymongo",
+        "bson",
+        "modules.database",
+        "threading",
+        "concurrent",
+        "asyncio",
+    )
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        slow_query_ms: float = 100,
+        history_size: int = 5000,
+    ):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.history = deque(maxlen=history_size)
+        self.counts = {}
+        self.started_queries = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def caller(self) -> str:
+        """Get the module and function outside of the database layer that made the query."""
+        caller = getattr(self.local, "caller", None)
+        if caller:
+            return caller
+
+        frame = sys._getframe(1)
+        while frame:
+            module = frame.f_globals.get("__name__", "")
+            if not module.startswith(self.internal_modules):
+                return f"{module}.{frame.f_code.co_name}"
+
+            frame = frame.f_back
+
+        return "unknown"
+
+    def run_as(self, caller: str, func: Callable, *args, **kwargs):
+        """Run func with queries made by it recorded as made by caller, used when queries are made in another thread."""
+        self.local.caller = caller
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.local.caller = None
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+
+        # commands that aren't run on a collection, like isMaster, aren't recorded
+        if not isinstance(collection, str):
+            return
+
+        key = (event.connection_id, event.request_id)
+        caller = self.caller()
+        with self.lock:
+            self.started_queries[key] = (collection, caller)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        reply = event.reply
+        if "cursor" in reply:
+            cursor = reply["cursor"]
+            documents = len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        else:
+            documents = reply.get("n", 0)
+
+        self.record(event, documents)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.record(event, 0)
+
+    def record(self, event, documents: int):
+        """Add a finished query to :attr:`history` and :attr:`counts`, logging it if it's slow."""
+        with self.lock:
+            started = self.started_queries.pop(
+                (event.connection_id, event.request_id), None
+            )
+        if started is None:
+            return
+
+        collection, caller = started
+        duration = event.duration_micros / 1000
+        with self.lock:
+            key = (collection, event.command_name)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.history.append(
+                (collection, event.command_name, duration, documents, caller)
+            )
+
+        if duration >= self.slow_query_ms:
+            logger.warning(
+                f"Slow query: {event.command_name} on {collection} took {duration:.2f}ms, "
+                f"returned {documents} documents, called from {caller}"
+            )
+
+    def top(self, limit: int = 10) -> list:
+        """
+        Get the collection operations that have spent the most time in the database out of the queries in :attr:`history`.
+
+        Parameters
+        ----------------
+        limit: :class:`int`
+            Max number of operations returned.
+
+        Returns
+        -------
+        :class:`list`
+            List of dicts with collection, operation, count, total_ms, p50, p95, p99, documents and callers keys,
+            sorted by total_ms.
+        """
+        with self.lock:
+            history = list(self.history)
+            counts = self.counts.copy()
+
+        grouped = {}
+        for collection, operation, duration, documents, caller in history:
+            group = grouped.setdefault(
+                (collection, operation),
+                {"durations": [], "documents": 0, "callers": {}},
+            )
+            group["durations"].append(duration)
+            group["documents"] += documents
+            group["callers"][caller] = group["callers"].get(caller, 0) + 1
+
+        offenders = []
+        for (collection, operation), group in grouped.items():
+            durations = sorted(group["durations"])
+            offenders.append(
+                {
+                    "collection": collection,
+                    "operation": operation,
+                    "count": counts.get((collection, operation), len(durations)),
+                    "total_ms": sum(durations),
+                    "p50": percentile(durations, 50),
+                    "p95": percentile(durations, 95),
+                    "p99": percentile(durations, 99),
+                    "documents": group["documents"],
+                    "callers": sorted(
+                        group["callers"], key=group["callers"].get, reverse=True
+                    ),
+                }
+            )
+
+        return sorted(offenders, key=lambda o: o["total_ms"], reverse=True)[:limit]
 
 
 class Connection:
@@ -329,7 +641,11 @@ class Connection:
     """
 
     def __init__(self):
-        self.mongo_client = pymongo.MongoClient(config.MONGODB_URL)
+        self.query_stats = QueryStats(**getattr(config, "DATABASE_INSTRUMENTATION", {}))
+        self.mongo_client = pymongo.MongoClient(
+            config.MONGODB_URL,
+            event_listeners=[self.query_stats] if self.query_stats.enabled else [],
+        )
         self.db = self.mongo_client["TLDR"]
         self.leveling_users = self.db["leveling_users"]
         self.leveling_data = self.db["leveling_data"]
@@ -362,6 +678,179 @@ class Connection:
         self.threading_profiles = self.db["threading_profiles"]
         self.threading_threads = self.db["threading_threads"]
         self.reprimands = self.db['reprimands']
+        self.cache = ReadCache(**getattr(config, "DATABASE_CACHE", {}))
+
+        # indexes of the hot queries, created on boot by ensure_indexes
+        # an index is either a list of keys or a tuple of keys and index options
+        self.indexes = {
+            "leveling_users": [
+                [("guild_id", 1), ("user_id", 1)],
+                [("guild_id", 1), ("pp", -1)],
+                [("guild_id", 1), ("hp", -1)],
+                [("guild_id", 1), ("rp", -1)],
+            ],
+            "left_leveling_users": [
+                [("guild_id", 1), ("user_id", 1)],
+                # documents are deleted by mongodb when expires_at has passed
+                ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+            ],
+            "timers": [
+                [("expires", 1)],
+                [("extras.message_id", 1)],
+                [("extras.main_poll_id", 1)],
+                [("claimed_by", 1)],
+                [("claimed_at", 1)],
+            ],
+            "slack_messages": [
+                [("slack_message_id", 1)],
+                [("discord_message_id", 1)],
+            ],
+            "custom_commands": [[("guild_id", 1)]],
+            "captcha_counter": [[("mid", 1)]],
+            "watchlist": [[("guild_id", 1), ("user_id", 1)]],
+            "threading_threads": [[("thread_id", 1)], [("first_message_id", 1)]],
+        }
+        # (filter, sort) of the hot queries, explained on boot by verify_indexes, values are placeholders
+        self.queries = {
+            "leveling_users": [
+                ({"guild_id": 0, "user_id": 0}, None),
+                ({"guild_id": 0}, None),
+                *(
+                    ({"guild_id": 0, f"{prefix}p": {"$gt": 0}}, [(f"{prefix}p", -1)])
+                    for prefix in "phr"
+                ),
+            ],
+            "left_leveling_users": [({"guild_id": 0, "user_id": 0}, None)],
+            "timers": [
+                ({"expires": {"$lte": 0}}, None),
+                ({"expires": {"$lte": 0, "$gt": 0}}, None),
+                ({"extras.message_id": 0}, None),
+                ({"event": "anon_poll", "extras.message_id": 0}, None),
+                ({"extras.main_poll_id": 0}, None),
+                ({"claimed_by": ObjectId()}, None),
+                ({"claimed_at": {"$lte": 0}}, None),
+            ],
+            "slack_messages": [
+                ({"slack_message_id": ""}, None),
+                ({"discord_message_id": 0}, None),
+            ],
+            "custom_commands": [({"guild_id": 0}, None)],
+            "captcha_counter": [({"mid": 0}, None)],
+            "watchlist": [
+                ({"guild_id": 0}, None),
+                ({"guild_id": 0, "user_id": 0}, None),
+            ],
+            "threading_threads": [
+                ({"thread_id": 0}, None),
+                ({"first_message_id": 0}, None),
+            ],
+        }
+
+    def ensure_indexes(self) -> list:
+        """
+        Create the indexes in :attr:`indexes` that don't exist yet, existing indexes are left as they are.
+
+        Returns
+        -------
+        :class:`list`
+            Names of the indexes.
+        """
+        names = []
+        for collection_name, indexes in self.indexes.items():
+            collection = self.db[collection_name]
+            try:
+                names += collection.create_indexes(
+                    [
+                        IndexModel(keys, **options)
+                        for keys, options in map(index_spec, indexes)
+                    ]
+                )
+            except OperationFailure as e:
+                logger.warning(f"Couldn't create indexes on {collection_name}: {e}")
+
+        return names
+
+    def verify_indexes(self) -> list:
+        """
+        Explain the hot queries in :attr:`queries` and warn about the ones that would scan the whole collection.
+
+        Returns
+        -------
+        :class:`list`
+            (collection name, query filter, sort) of the queries that scan the whole collection.
+        """
+        collection_scans = []
+        for collection_name, queries in self.queries.items():
+            collection = self.db[collection_name]
+            for query_filter, sort in queries:
+                cursor = collection.find(query_filter)
+                if sort:
+                    cursor = cursor.sort(sort)
+
+                plan = cursor.explain()["queryPlanner"]["winningPlan"]
+                # slot based execution engine nests the plan under queryPlan
+                plan = plan.get("queryPlan", plan)
+                if "COLLSCAN" in plan_stages(plan):
+                    logger.warning(
+                        f"Query {query_filter} sort {sort} on {collection_name} scans the whole collection"
+                    )
+                    collection_scans.append((collection_name, query_filter, sort))
+
+        return collection_scans
+
+    def index_usage(self) -> dict:
+        """
+        Get how many times the indexes of collections in :attr:`indexes` have been used.
+
+        Returns
+        -------
+        :class:`dict`
+            Dict of collection name to dict of index name to number of operations that used the index
+            since the index was created or the database was restarted.
+        """
+        usage = {}
+        for collection_name in self.indexes:
+            index_stats = self.db[collection_name].aggregate([{"$indexStats": {}}])
+            usage[collection_name] = {
+                stats["name"]: stats["accesses"]["ops"] for stats in index_stats
+            }
+
+        return usage
+
+    def migrate_left_leveling_users(self):
+        """
+        Move the expiry of left_leveling_users from leveling_data_expires timers to the expires_at field,
+        which is handled by a TTL index. Does nothing once the timers have been migrated.
+        """
+        timers = list(self.timers.find({"event": "leveling_data_expires"}))
+        if timers:
+            self.left_leveling_users.bulk_write(
+                [
+                    pymongo.UpdateMany(
+                        {
+                            "guild_id": timer["guild_id"],
+                            "user_id": timer["extras"]["user_id"],
+                        },
+                        {
+                            "$set": {
+                                "expires_at": datetime.datetime.utcfromtimestamp(
+                                    timer["expires"]
+                                )
+                            }
+                        },
+                    )
+                    for timer in timers
+                ],
+                ordered=False,
+            )
+            self.timers.delete_many({"event": "leveling_data_expires"})
+            logger.info(f"Migrated {len(timers)} leveling_data_expires timers.")
+
+        # data without a timer would have been kept forever, it's given the usual 30 days
+        self.left_leveling_users.update_many(
+            {"expires_at": {"$exists": False}},
+            {"$set": {"expires_at": datetime.datetime.utcnow() + left_data_lifetime}},
+        )
 
     def clear_bills_tracker_collection(self):
         self.bills_tracker.delete_many({})
@@ -476,11 +965,16 @@ class Connection:
         :class:`dict`
             Guild's settings.
         """
+        guild_settings = self.cache.get("guild_settings", guild_id)
+        if guild_settings is not None:
+            return guild_settings
+
         guild_settings = self.guild_settings.find_one({"guild_id": guild_id})
         if guild_settings is None:
             guild_settings = {"guild_id": guild_id, "mute_role_id": None, "modules": {}}
             self.guild_settings.insert_one(guild_settings)
 
+        self.cache.set("guild_settings", guild_id, guild_settings)
         return guild_settings
 
     def get_leveling_user(self, guild_id: int, member_id: int) -> dict:
@@ -531,15 +1025,19 @@ class Connection:
         if fields is None:
             fields = {}
 
-        if fields:
-            leveling_data = self.leveling_data.find_one({"guild_id": guild_id}, fields)
-        else:
+        # the whole document is cached, fields are projected from the cached copy
+        leveling_data = self.cache.get("leveling_data", guild_id)
+        if leveling_data is None:
             leveling_data = self.leveling_data.find_one({"guild_id": guild_id})
+            if not leveling_data:
+                leveling_data = schemas["leveling_data"]
+                leveling_data["guild_id"] = guild_id
+                self.leveling_data.insert_one(leveling_data.copy())
 
-        if not leveling_data:
-            leveling_data = schemas["leveling_data"]
-            leveling_data["guild_id"] = guild_id
-            self.leveling_data.insert_one(leveling_data.copy())
+            self.cache.set("leveling_data", guild_id, leveling_data)
+
+        if fields:
+            leveling_data = project(leveling_data, fields)
 
         return leveling_data
 
@@ -559,15 +1057,23 @@ class Connection:
         :class:`dict`
             The command data.
         """
+        command_data = self.cache.get("commands", command_name)
+        if command_data is not None:
+            return command_data
+
         command_data = self.commands.find_one({"command_name": command_name})
         if command_data is None:
             command_data = {
                 "command_name": command_name,
                 "disabled": 0,
             }
-            if insert:
-                self.commands.insert_one(command_data)
+            if not insert:
+                # not cached, so a later call with insert=True still inserts it
+                return command_data
 
+            self.commands.insert_one(command_data)
+
+        self.cache.set("commands", command_name, command_data)
         return command_data
 
     def get_daily_debates(self, guild_id: int) -> dict:
@@ -584,12 +1090,17 @@ class Connection:
         :class:`dict`
             The daily debate data.
         """
+        daily_debates = self.cache.get("daily_debates", guild_id)
+        if daily_debates is not None:
+            return daily_debates
+
         daily_debates = self.daily_debates.find_one({"guild_id": guild_id})
         if not daily_debates:
             daily_debates = schemas["daily_debates"]
             daily_debates["guild_id"] = guild_id
             self.daily_debates.insert_one(daily_debates)
 
+        self.cache.set("daily_debates", guild_id, daily_debates)
         return daily_debates
 
     def get_automember(self, guild_id: int) -> bool:
@@ -611,6 +1122,7 @@ class Connection:
             self.leveling_data.update_one(
                 {"guild_id": guild_id}, {"$set": {"automember": False}}
             )
+            self.cache.invalidate("leveling_data", guild_id)
             automember = False
         else:
             automember = leveling_data["automember"]
@@ -650,6 +1162,208 @@ class Connection:
         self.cases.update_one({"_id": case_id}, {"$set": {"logs_url": logs_url}})
 
 
+class AsyncCollection:
+    """
+    Asyncio version of :class:`pymongo.collection.Collection`.
+
+    Blocking methods are run in the thread pool of :class:`AsyncConnection` and awaited, so queries don't block
+    the event loop. Methods that return cursors return lists instead.
+
+    Attributes
+    ---------------
+    collection: :class:`pymongo.collection.Collection`
+        The wrapped collection.
+    connection: :class:`AsyncConnection`
+        The async connection the collection belongs to.
+    """
+
+    cursor_methods = {"find", "aggregate"}
+    blocking_methods = {
+        "find_one",
+        "insert_one",
+        "insert_many",
+        "update_one",
+        "update_many",
+        "replace_one",
+        "delete_one",
+        "delete_many",
+        "count_documents",
+        "distinct",
+        "bulk_write",
+        "find_one_and_update",
+        "find_one_and_delete",
+        "find_one_and_replace",
+        "create_index",
+        "create_indexes",
+    }
+
+    def __init__(self, collection: Collection, connection: "AsyncConnection"):
+        self.collection = collection
+        self.connection = connection
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if name in self.cursor_methods:
+            return functools.partial(self.connection.run, self._to_list, attr)
+        if name in self.blocking_methods:
+            return functools.partial(self.connection.run, attr)
+
+        return attr
+
+    @staticmethod
+    def _to_list(method: Callable, *args, **kwargs) -> list:
+        """Calls a method that returns a cursor and exhausts the cursor in the same thread."""
+        return list(method(*args, **kwargs))
+
+
+class AsyncConnection:
+    """
+    Asyncio access layer over :class:`Connection`.
+
+    Collections are returned as :class:`AsyncCollection` and all the helper methods of :class:`Connection`
+    (get_leveling_user, get_guild_settings, get_command_data, get_cases etc.) are returned as coroutine functions.
+    Both use the same pymongo client as :class:`Connection`, so modules can move over one at a time by using
+    :func:`get_async_connection` instead of :func:`get_connection`.
+
+    Attributes
+    ---------------
+    connection: :class:`Connection`
+        The blocking connection.
+    executor: :class:`concurrent.futures.ThreadPoolExecutor`
+        Thread pool the blocking calls are run in.
+    """
+
+    def __init__(self, connection: Connection, *, max_workers: int = 8):
+        self.connection = connection
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="mongodb"
+        )
+        self._collections = {}
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """
+        Run a blocking function in :attr:`executor`.
+
+        Parameters
+        ----------------
+        func: :class:`Callable`
+            The function.
+        *args:
+            Args passed to the function.
+        **kwargs:
+            Kwargs passed to the function.
+
+        Returns
+        -------
+            The return value of the function.
+        """
+        loop = asyncio.get_event_loop()
+        query_stats = self.connection.query_stats
+        if query_stats.enabled:
+            # the caller can't be found from the stack of the executor thread
+            args = (query_stats.caller(), func, *args)
+            func = query_stats.run_as
+
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if isinstance(attr, Collection):
+            if name not in self._collections:
+                self._collections[name] = AsyncCollection(attr, self)
+
+            return self._collections[name]
+
+        # only the helper methods of Connection are run in the executor, other attributes like the database
+        # and the cache are returned as they are
+        if inspect.ismethod(attr) and attr.__self__ is self.connection:
+            return functools.partial(self.run, attr)
+
+        return attr
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Get a percentile of sorted values with the nearest rank method.
+
+    Parameters
+    ----------------
+    values: :class:`list`
+        The values, sorted in ascending order.
+    percent: :class:`float`
+        The percentile, 0-100.
+
+    Returns
+    -------
+    :class:`float`
+        The percentile, 0 if there are no values.
+    """
+    if not values:
+        return 0
+
+    index = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def index_spec(index: Union[list, tuple]) -> tuple:
+    """Get the keys and options of an index in :attr:`Connection.indexes`."""
+    if isinstance(index, tuple):
+        return index
+
+    return index, {}
+
+
+def plan_stages(plan: dict) -> list:
+    """
+    Get the stages of a query plan returned by explain.
+
+    Parameters
+    ----------------
+    plan: :class:`dict`
+        The query plan.
+
+    Returns
+    -------
+    :class:`list`
+        Names of the stages of the plan and its input stages.
+    """
+    stages = [plan.get("stage")]
+    for input_stage in [plan.get("inputStage"), *plan.get("inputStages", [])]:
+        if input_stage:
+            stages += plan_stages(input_stage)
+
+    return stages
+
+
+def project(document: dict, fields: dict) -> dict:
+    """
+    Apply a mongodb style projection of top level fields to a document.
+
+    Parameters
+    ----------------
+    document: :class:`dict`
+        The document.
+    fields: :class:`dict`
+        The projection, either only inclusions or only exclusions, _id is included unless excluded.
+
+    Returns
+    -------
+    :class:`dict`
+        The projected document.
+    """
+    if any(value for key, value in fields.items() if key != "_id"):
+        keys = [key for key, value in fields.items() if value]
+        if fields.get("_id", 1):
+            keys.append("_id")
+
+        return {key: document[key] for key in keys if key in document}
+
+    excluded = [key for key, value in fields.items() if not value]
+    return {key: value for key, value in document.items() if key not in excluded}
+
+
 def get_connection():
     """
     Set the global connection variable active_connection to an active connection to the database.
@@ -663,6 +1377,19 @@ def get_connection():
     return active_connection
 
 
+def get_async_connection():
+    """
+    Set the global connection variable active_async_connection to an :class:`AsyncConnection` over
+    the active connection. If it's already set, it returns active_async_connection.
+    """
+
+    global active_async_connection
+    if active_async_connection is None:
+        active_async_connection = AsyncConnection(get_connection())
+
+    return active_async_connection
+
+
 schemas = {
     "leveling_user": {
         "pp": 0,  # Participation points or parliamentary points
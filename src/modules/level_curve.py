@@ -0,0 +1,129 @@
+import math
+from typing import Iterable, Union
+
+import numpy
+
+# highest level in the precomputed table, reaching it takes ~1.7 billion points
+MAX_LEVEL = 1000
+
+
+def points_for_level(level: Union[int, float]) -> int:
+    """
+    Evaluates the level curve formula.
+
+    Parameters
+    ----------------
+    level: Union[:class:`int`, :class:`float`]
+        The level.
+
+    Returns
+    -------
+    :class:`int`
+        Total points needed to reach the level.
+    """
+    return round(5 / 6 * level * (2 * level * level + 27 * level + 91))
+
+
+# total points needed to reach every level from 0 to MAX_LEVEL, total_points_table[level]
+total_points_table = numpy.array(
+    [points_for_level(level) for level in range(MAX_LEVEL + 1)], dtype=numpy.int64
+)
+
+
+def total_points(level: Union[int, float]) -> int:
+    """
+    Get the total points needed to reach a level.
+
+    Levels in the table are looked up, anything else is calculated with :func:`points_for_level`.
+
+    Parameters
+    ----------------
+    level: Union[:class:`int`, :class:`float`]
+        The level.
+
+    Returns
+    -------
+    :class:`int`
+        Total points needed to reach the level.
+    """
+    if float(level).is_integer() and 0 <= level <= MAX_LEVEL:
+        return int(total_points_table[int(level)])
+
+    return points_for_level(level)
+
+
+def level_from_points(points: Union[int, float]) -> int:
+    """
+    Get the level that an amount of points gives.
+
+    Parameters
+    ----------------
+    points: Union[:class:`int`, :class:`float`]
+        The amount of points.
+
+    Returns
+    -------
+    :class:`int`
+        The highest level whose total points are smaller or equal to points, capped at :data:`MAX_LEVEL`.
+    """
+    return int(numpy.searchsorted(total_points_table, points, side="right")) - 1
+
+
+def levels_from_points(points: Iterable[Union[int, float]]) -> numpy.ndarray:
+    """
+    Vectorized :func:`level_from_points`, for getting the levels of many users at once.
+
+    Parameters
+    ----------------
+    points: Iterable[Union[:class:`int`, :class:`float`]]
+        Points of the users.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        Levels of the users, in the same order as points.
+    """
+    points = numpy.asarray(points)
+    return numpy.searchsorted(total_points_table, points, side="right") - 1
+
+
+def levels_up(level: int, points: Union[int, float]) -> int:
+    """
+    Calculate how many levels a user needs to go up from their current level.
+
+    Parameters
+    ----------------
+    level: :class:`int`
+        The current level of the user.
+    points: Union[:class:`int`, :class:`float`]
+        The points of the user.
+
+    Returns
+    -------
+    :class:`int`
+        The number of levels the user needs to go up.
+    """
+    return max(level_from_points(points) - level, 0)
+
+
+def percent_till_next_level(level: int, points: Union[int, float]) -> float:
+    """
+    Get the percent number of how close user is to leveling up.
+
+    Parameters
+    ----------------
+    level: :class:`int`
+        The current level of the user.
+    points: Union[:class:`int`, :class:`float`]
+        The points of the user.
+
+    Returns
+    -------
+    :class:`float`
+        The percent number, with one decimal point of how close user is to leveling up
+    """
+    # points needed to gain next level from beginning of user level
+    points_to_level_up = 5 * (level**2) + 50 * level + 100
+    points_needed = total_points(level + 1) - int(points)
+
+    return math.floor((100 - ((points_needed * 100) / points_to_level_up)) * 10) / 10
@@ -1,20 +1,449 @@
 from __future__ import annotations
 
-import math
+import asyncio
 import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Optional, Tuple, Union
+from typing import Callable, List, Optional, Tuple, Union
 
 import config
 import discord
+import numpy
+from cachetools import TTLCache
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 
-from modules import database
+from modules import database, level_curve, timers
 from modules.utils import get_guild_role, get_member_by_id
 
 db = database.get_connection()
 
 
+class LevelingWriteBuffer:
+    """
+    Write-behind buffer for leveling_users updates.
+
+    Instead of every attribute change issuing its own update_one, changed fields are merged in memory per
+    (guild_id, user_id) and written out in a single bulk_write when :meth:`flush` is called.
+    Flushes happen on an interval from :class:`LevelingSystem`, when the buffer reaches :attr:`max_size` users
+    and when the bot shuts down.
+
+    Attributes
+    ---------------
+    collection: :class:`pymongo.collection.Collection`
+        The collection the buffered writes will be applied to.
+    max_size: :class:`int`
+        Number of dirty users after which the buffer flushes itself.
+    pending: :class:`dict`
+        Dirty fields keyed by (guild_id, user_id).
+    """
+
+    def __init__(self, collection: Collection, *, max_size: int = 500):
+        self.collection = collection
+        self.max_size = max_size
+        self.pending = {}
+
+    def set(self, guild_id: int, user_id: int, key: str, value) -> None:
+        """
+        Buffer a `$set` of `key` to `value` for a user.
+
+        Parameters
+        ----------------
+        guild_id: :class:`int`
+            ID of the user's guild.
+        user_id: :class:`int`
+            ID of the user.
+        key: :class:`str`
+            The database key that will be set.
+        value:
+            The new value.
+        """
+        self.pending.setdefault((guild_id, user_id), {})[key] = value
+        if len(self.pending) >= self.max_size:
+            self.flush()
+
+    def get_pending(self, guild_id: int, user_id: int) -> dict:
+        """Get the fields of a user that haven't been written to the database yet."""
+        return self.pending.get((guild_id, user_id), {})
+
+    def flush(self) -> int:
+        """
+        Write all the buffered changes to the database with one bulk_write.
+
+        Returns
+        -------
+        :class:`int`
+            The number of users whose data was written.
+        """
+        if not self.pending:
+            return 0
+
+        pending, self.pending = self.pending, {}
+        requests = [
+            UpdateOne({"guild_id": guild_id, "user_id": user_id}, {"$set": fields})
+            for (guild_id, user_id), fields in pending.items()
+        ]
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception:
+            # put the changes back, so they're written on the next flush, fields set since the swap are newer
+            for key, fields in pending.items():
+                self.pending[key] = {**fields, **self.pending.get(key, {})}
+            raise
+
+        return len(requests)
+
+
+write_buffer = LevelingWriteBuffer(db.leveling_users)
+
+
+class RankIndex:
+    """
+    In-memory index of the points every user in a guild has on one branch, used to get ranks without querying the database.
+
+    Points are kept in an ascending sorted list, so a rank lookup is a binary search.
+
+    Attributes
+    ---------------
+    points: :class:`dict`
+        Points of every indexed user, keyed by user id.
+    sorted_points: :class:`list`
+        All the values of :attr:`points` in ascending order.
+    """
+
+    def __init__(self, points: dict = None):
+        self.points = dict(points or {})
+        self.sorted_points = sorted(self.points.values())
+        # incremented on every change, so snapshots of the index know when they're outdated
+        self.version = 0
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, user_id: int):
+        return user_id in self.points
+
+    def update(self, user_id: int, points: int) -> None:
+        """
+        Set the points of a user, adding them to the index if they aren't in it.
+
+        Parameters
+        ----------------
+        user_id: :class:`int`
+            ID of the user.
+        points: :class:`int`
+            The user's new points.
+        """
+        if user_id in self.points:
+            old_points = self.points[user_id]
+            if old_points == points:
+                return
+
+            del self.sorted_points[bisect_left(self.sorted_points, old_points)]
+
+        self.points[user_id] = points
+        insort(self.sorted_points, points)
+        self.version += 1
+
+    def remove(self, user_id: int) -> None:
+        """Remove a user from the index."""
+        if user_id not in self.points:
+            return
+
+        old_points = self.points.pop(user_id)
+        del self.sorted_points[bisect_left(self.sorted_points, old_points)]
+        self.version += 1
+
+    def rank(self, points: int) -> int:
+        """
+        Get the rank that the given amount of points has in the index.
+
+        Parameters
+        ----------------
+        points: :class:`int`
+            The amount of points.
+
+        Returns
+        -------
+        :class:`int`
+            Number of users who have at least as many points.
+        """
+        return len(self.sorted_points) - bisect_left(self.sorted_points, points)
+
+
+class LeaderboardSnapshot:
+    """
+    Sorted snapshot of a :class:`RankIndex`, used by the leaderboard command.
+
+    Only users with more than 0 points are included.
+
+    Attributes
+    ---------------
+    version: :class:`int`
+        The version of the :class:`RankIndex` the snapshot was made from.
+    created_at: :class:`float`
+        Time when the snapshot was made.
+    users: :class:`list`
+        (user_id, points) tuples sorted by points in descending order.
+    positions: :class:`dict`
+        Index of every user in :attr:`users`, keyed by user id.
+    """
+
+    def __init__(self, rank_index: RankIndex):
+        self.version = rank_index.version
+        self.created_at = time.time()
+        self.users = sorted(
+            (
+                (user_id, points)
+                for user_id, points in rank_index.points.items()
+                if points > 0
+            ),
+            key=lambda user: user[1],
+            reverse=True,
+        )
+        self.positions = {user_id: i for i, (user_id, _) in enumerate(self.users)}
+
+    def __len__(self):
+        return len(self.users)
+
+    def position(self, user_id: int) -> int:
+        """
+        Get the index of a user in :attr:`users`.
+
+        Parameters
+        ----------------
+        user_id: :class:`int`
+            ID of the user.
+
+        Returns
+        -------
+        :class:`int`
+            The index of the user or length of :attr:`users` if the user isn't on the leaderboard.
+        """
+        return self.positions.get(user_id, len(self.users))
+
+
+class MemberCache:
+    """
+    LRU cache of :class:`LevelingMember` objects with a time to live.
+
+    Members that haven't been used for :attr:`ttl` seconds or are the least recently used when the cache is over
+    :attr:`max_size` are evicted.
+
+    Attributes
+    ---------------
+    max_size: :class:`int`
+        Maximum number of members in the cache.
+    ttl: :class:`int`
+        Seconds after which a member who hasn't been used is evicted.
+    members: :class:`collections.OrderedDict`
+        (LevelingMember, last used time) tuples keyed by member id, least recently used first.
+    hits: :class:`int`
+        How many times a member was found in the cache.
+    misses: :class:`int`
+        How many times a member wasn't found in the cache.
+    evictions: :class:`int`
+        How many members have been evicted from the cache.
+    """
+
+    def __init__(self, *, max_size: int = 5000, ttl: int = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.members = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        yield from (member for member, _ in self.members.values())
+
+    def get(self, member_id: int) -> Optional[LevelingMember]:
+        """
+        Get a member from the cache.
+
+        Parameters
+        ----------------
+        member_id: :class:`int`
+            ID of the member.
+
+        Returns
+        -------
+        Optional[:class:`LevelingMember`]
+            The LevelingMember or `None` if member isn't cached or has expired.
+        """
+        entry = self.members.get(member_id)
+        now = time.monotonic()
+        if entry is not None and now - entry[1] > self.ttl:
+            del self.members[member_id]
+            self.evictions += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.members[member_id] = (entry[0], now)
+        self.members.move_to_end(member_id)
+        return entry[0]
+
+    def add(self, member: LevelingMember) -> None:
+        """Add a member to the cache and evict expired and least recently used members."""
+        now = time.monotonic()
+        self.members[member.id] = (member, now)
+        self.members.move_to_end(member.id)
+
+        while self.members:
+            _, (_, last_used) = next(iter(self.members.items()))
+            if len(self.members) <= self.max_size and now - last_used <= self.ttl:
+                break
+
+            self.members.popitem(last=False)
+            self.evictions += 1
+
+    def peek(self, member_id: int) -> Optional[LevelingMember]:
+        """Get a member from the cache without marking them as used or counting a hit or a miss."""
+        entry = self.members.get(member_id)
+        return entry[0] if entry is not None else None
+
+    def remove(self, member_id: int) -> None:
+        """Remove a member from the cache."""
+        self.members.pop(member_id, None)
+
+    def stats(self) -> dict:
+        """Returns cache size and counters in the form of a dictionary."""
+        return {
+            "size": len(self.members),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class RoleAssigner:
+    """
+    Deduplicating queue for giving leveling and automember roles to members.
+
+    Roles that are known to be applied to a member are remembered, so members who already have a role don't cause
+    REST calls. All the roles queued for a member are given in one call and calls are spaced out by
+    :attr:`interval` so bursts of level ups don't hit the rate limit.
+
+    Attributes
+    ---------------
+    bot: :class:`TLDR`
+        The bot instance.
+    interval: :class:`float`
+        Seconds to wait between add_roles calls.
+    applied: :class:`cachetools.TTLCache`
+        IDs of roles known to be applied to a member, keyed by (guild_id, member_id),
+        members who haven't been given roles in a while are evicted.
+    pending: :class:`dict`
+        Roles waiting to be given to a member, keyed by (guild_id, member_id).
+    queue: :class:`asyncio.Queue`
+        Queue of (guild_id, member_id) keys that have pending roles.
+    """
+
+    def __init__(
+        self,
+        bot,
+        *,
+        interval: float = 0.25,
+        applied_max_size: int = 10000,
+        applied_ttl: int = 3600,
+    ):
+        self.bot = bot
+        self.interval = interval
+        self.applied = TTLCache(maxsize=applied_max_size, ttl=applied_ttl)
+        self.pending = {}
+        self.queue = asyncio.Queue()
+
+    def has_role(self, member: discord.Member, role_id: int) -> bool:
+        """
+        Check if member has a role or if the role is already queued to be given to them.
+
+        Parameters
+        ----------------
+        member: :class:`discord.Member`
+            The member.
+        role_id: :class:`int`
+            ID of the role.
+
+        Returns
+        -------
+        :class:`bool`
+            True if the member has or is about to get the role, False otherwise.
+        """
+        key = (member.guild.id, member.id)
+        if role_id in self.applied.get(key, ()):
+            return True
+
+        if any(role.id == role_id for role in self.pending.get(key, ())):
+            return True
+
+        return member.get_role(role_id) is not None
+
+    def add(self, member: discord.Member, role: discord.Role) -> None:
+        """
+        Queue a role to be given to a member, unless they already have it.
+
+        Parameters
+        ----------------
+        member: :class:`discord.Member`
+            The member.
+        role: :class:`discord.Role`
+            The role that will be given to the member.
+        """
+        if role is None or self.has_role(member, role.id):
+            return
+
+        key = (member.guild.id, member.id)
+        if key not in self.pending:
+            self.pending[key] = []
+            self.queue.put_nowait(key)
+
+        self.pending[key].append(role)
+
+    def forget(self, guild_id: int, member_id: int) -> None:
+        """Forget the known roles of a member."""
+        self.applied.pop((guild_id, member_id), None)
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        """Keeps :attr:`applied` fresh when roles of a member change."""
+        key = (after.guild.id, after.id)
+        if key in self.applied and before.roles != after.roles:
+            self.applied[key] = {role.id for role in after.roles}
+
+    async def run(self):
+        """Gives queued roles to members one member at a time."""
+        while True:
+            key = await self.queue.get()
+            roles = self.pending.pop(key, [])
+            guild = self.bot.get_guild(key[0])
+            member = guild.get_member(key[1]) if guild else None
+            if member is None or not roles:
+                continue
+
+            try:
+                await member.add_roles(*roles)
+                self.applied.setdefault(key, {r.id for r in member.roles}).update(
+                    role.id for role in roles
+                )
+            except discord.HTTPException as e:
+                self.bot.logger.error(
+                    f"Failed to give roles {[r.name for r in roles]} to {member} [{member.id}]: {e}"
+                )
+            except Exception as e:
+                # the task gives roles to everyone, so it can't be allowed to stop
+                await self.bot.on_event_error(e, "role_assigner")
+
+            await asyncio.sleep(self.interval)
+
+
 class DatabaseList(list):
     """
     Special list which co-opts the append, remove and other methods, so the same values can be updated in the database.
@@ -32,16 +461,34 @@ class DatabaseList(list):
         Key used in database queries when setting value.
     *args:
         Initial values that will be set in the list.
+    on_change: Optional[Callable]
+        Function called after the list has been modified.
     """
 
-    def __init__(self, collection: Collection, query_filter: dict, key: str, *args):
+    def __init__(
+        self,
+        collection: Collection,
+        query_filter: dict,
+        key: str,
+        *args,
+        on_change: Callable = None,
+    ):
         self.collection = collection
         self.query_filter = query_filter
         self.key = key
+        self.on_change = on_change
 
         super().__init__()
         self.extend(list(args))
 
+    def changed(self):
+        """Invalidates the cached document and calls :attr:`on_change` if it's set."""
+        if "guild_id" in self.query_filter:
+            db.cache.invalidate(self.collection.name, self.query_filter["guild_id"])
+
+        if self.on_change:
+            self.on_change()
+
     def __delitem__(self, index: int):
         """Hard to implement, so it will raise exception."""
         raise Exception("Del operation not allowed on DatabaseList")
@@ -59,6 +506,7 @@ class DatabaseList(list):
             },
         )
         super()[index] = value
+        self.changed()
 
     def insert(self, index: int, value):
         """Hard to implement, so it will raise exception."""
@@ -75,6 +523,7 @@ class DatabaseList(list):
             },
         )
         super().append(item)
+        self.changed()
 
     def remove(self, item) -> None:
         """Method that removes item from list and database list."""
@@ -87,6 +536,7 @@ class DatabaseList(list):
             },
         )
         super().remove(item)
+        self.changed()
 
 
 class Boost:
@@ -322,14 +772,23 @@ class LevelingUserBranch:
                 "level": f"{self.branch.name[0]}_level",
                 "role": f"{self.branch.name[0]}_role",
             }
-            db.leveling_users.update_one(
-                {
-                    "guild_id": self.leveling_member.guild.id,
-                    "user_id": self.leveling_member.id,
-                },
-                {"$set": {key_switch.get(key): value}},
+            write_buffer.set(
+                self.leveling_member.guild.id,
+                self.leveling_member.id,
+                key_switch.get(key),
+                value,
             )
 
+            if key == "points":
+                self.leveling_member.guild.rank_indexes[key_switch[key]].update(
+                    self.leveling_member.id, value
+                )
+                # role counts only include users with points on the branch
+                if (self.__dict__[key] > 0) != (value > 0):
+                    self.leveling_member.guild.invalidate_role_counts(self.branch)
+            elif key == "role":
+                self.leveling_member.guild.invalidate_role_counts(self.branch)
+
         self.__dict__[key] = value
 
 
@@ -431,14 +890,15 @@ class LevelingUser:
             and key in self.__dict__
             and self.__dict__[key] != value
         ):
-            db.leveling_users.update_one(
-                {
-                    "guild_id": self.leveling_member.guild.id,
-                    "user_id": self.leveling_member.id,
-                },
-                {"$set": {key: value}},
+            write_buffer.set(
+                self.leveling_member.guild.id, self.leveling_member.id, key, value
             )
 
+            if key == "rp":
+                self.leveling_member.guild.rank_indexes[key].update(
+                    self.leveling_member.id, value
+                )
+
         self.__dict__[key] = value
 
 
@@ -487,7 +947,6 @@ class LevelingRole:
         :class:`discord.Role`
             The discord role.
         """
-        # TODO: maybe cache this value?
         role = await get_guild_role(self.guild, self.name)
         # if role doesnt exist, create it
         if role is None:
@@ -511,6 +970,10 @@ class LevelingRole:
                 },
                 {f"$set": {f"leveling_routes.{self.name}.$.{key}": value}},
             )
+            db.cache.invalidate("leveling_data", self.guild.id)
+
+            if key == "name":
+                self.branch.clear_role_cache()
 
         # special case for perks
         if key == "perks" and "perks" in self.__dict__:
@@ -537,13 +1000,49 @@ class LevelingRoute:
     def __init__(self, guild: discord.Guild, name: str, roles: list):
         self.guild = guild
         self.name = name
+        # lowercase role names and role positions, built when first needed
+        self._role_names = None
+        self._role_positions = None
         self.roles = DatabaseList(
             db.leveling_data,
             {"guild_id": self.guild.id},
             f"leveling_routes.{self.name}",
             *[LevelingRole(guild, self, role) for role in roles],
+            on_change=self.clear_role_cache,
         )
 
+    def clear_role_cache(self):
+        """Clears cached role names and positions, called when roles are modified."""
+        self._role_names = None
+        self._role_positions = None
+
+    def role_position(self, role: LevelingRole) -> int:
+        """
+        Get the index of a role in :attr:`roles`.
+
+        Parameters
+        ----------------
+        role: :class:`LevelingRole`
+            The role.
+
+        Returns
+        -------
+        :class:`int`
+            The index of the role.
+
+        Raises
+        -------
+        ValueError
+            If the role isn't in the route.
+        """
+        if self._role_positions is None:
+            self._role_positions = {r: i for i, r in enumerate(self.roles)}
+
+        if role not in self._role_positions:
+            raise ValueError(f"{role.name} is not in {self.name} roles")
+
+        return self._role_positions[role]
+
     def find_role(self, role_name: str) -> Optional[LevelingRole]:
         """
         Get a role in the LevelingRoute.
@@ -558,9 +1057,12 @@ class LevelingRoute:
         Optional[:class:`LevelingRole`]
             The LevelingRole or `None` if it isn't found.
         """
-        for role in self.roles:
-            if role.name.lower() == role_name.lower():
-                return role
+        if self._role_names is None:
+            self._role_names = {}
+            for role in self.roles:
+                self._role_names.setdefault(role.name.lower(), role)
+
+        return self._role_names.get(role_name.lower())
 
     def __iter__(self):
         """Iterator magic method to loop over the LevelingRoute's roles."""
@@ -631,6 +1133,8 @@ class LevelingData:
         The leveling routes of LevelingGuild.
     honours_channels :class:`DatabaseList`
         List of honours channels.
+    honours_channel_ids :class:`set`
+        Set of the ids in :attr:`honours_channels`.
     automember :class:`bool`
         True if automember functionality is enabled, defaults to False if not set in the database.
     """
@@ -642,20 +1146,32 @@ class LevelingData:
         self.leveling_routes = LevelingRoutes(
             guild, leveling_data.get("leveling_routes", {})
         )
+        self.honours_channel_ids = set()
         self.honours_channels = DatabaseList(
             db.leveling_data,
             {"guild_id": guild.id},
             f"honours_channels",
             *leveling_data.get("honours_channels", []),
+            on_change=self.update_honours_channel_ids,
         )
+        self.update_honours_channel_ids()
         self.automember = leveling_data.get("automember", False)
 
+    def update_honours_channel_ids(self):
+        """Updates the set of honours channel ids used for quick lookups on every message."""
+        self.honours_channel_ids = set(self.honours_channels)
+
+    def is_honours_channel(self, channel_id: int) -> bool:
+        """Check if a channel is an honours channel."""
+        return channel_id in self.honours_channel_ids
+
     def toggle_automember(self):
         """Toggle :attr:`automember` and in the database."""
         self.automember = not bool(self.automember)
         db.leveling_data.update_one(
             {"guild_id": self.guild.id}, {"$set": {"automember": self.automember}}
         )
+        db.cache.invalidate("leveling_data", self.guild.id)
 
     def __setattr__(self, key, value):
         """For some variables, changing their value will also edit the entry in the database."""
@@ -667,6 +1183,7 @@ class LevelingData:
             db.leveling_data.update_one(
                 {"guild_id": self.guild.id}, {"$set": {key: value}}
             )
+            db.cache.invalidate("leveling_data", self.guild.id)
 
         # special case for honours_channels
         if key == "honours_channels" and "honours_channels" in self.__dict__:
@@ -689,21 +1206,302 @@ class LevelingGuild(LevelingData):
         The discord guild object.
     id: :class:`int`
         The discord id of the guild.
-    members :class:`List[:class:`LevelingMember`]`
-        List of LevelingMembers that belong to this guild.
+    members :class:`MemberCache`
+        Cache of LevelingMembers that belong to this guild.
+    rank_indexes: :class:`dict`
+        :class:`RankIndex` of every points key (pp, hp and rp).
+    leaderboards: :class:`dict`
+        Latest :class:`LeaderboardSnapshot` of every points key.
+    role_counts: :class:`dict`
+        Cached number of users who have each role, keyed by the first letter of the branch and the role name.
     """
 
+    rank_keys = ("pp", "hp", "rp")
+    # how many seconds an outdated leaderboard snapshot can still be used for
+    leaderboard_ttl = 5
+
     # TODO: remove user function
     def __init__(self, bot, guild: discord.Guild):
         self.bot = bot
         self.guild = guild
         self.id = guild.id
 
-        self.members = []
+        self.members = MemberCache(**getattr(config, "LEVELING_MEMBER_CACHE", {}))
+        self.rank_indexes = {}
+        self.leaderboards = {}
+        self.role_counts = {}
 
         leveling_data = db.get_leveling_data(guild.id)
         super().__init__(guild, leveling_data)
 
+        self.build_rank_indexes()
+
+    def build_rank_indexes(self):
+        """Build :attr:`rank_indexes` from the points of all the guild's users in the database."""
+        points = {key: {} for key in self.rank_keys}
+        leveling_users = db.leveling_users.find(
+            {"guild_id": self.id}, {key: 1 for key in ("user_id", *self.rank_keys)}
+        )
+        for leveling_user in leveling_users:
+            for key in self.rank_keys:
+                points[key][leveling_user["user_id"]] = leveling_user.get(key, 0)
+
+        self.rank_indexes = {key: RankIndex(points[key]) for key in self.rank_keys}
+
+    def index_user(self, leveling_user: dict):
+        """
+        Add or update a user in :attr:`rank_indexes`.
+
+        Parameters
+        ----------------
+        leveling_user: :class:`dict`
+            The user's leveling data.
+        """
+        for key in self.rank_keys:
+            self.rank_indexes[key].update(
+                leveling_user["user_id"], leveling_user.get(key, 0)
+            )
+
+        self.invalidate_role_counts()
+
+    def unindex_user(self, user_id: int):
+        """Remove a user from :attr:`rank_indexes`."""
+        for rank_index in self.rank_indexes.values():
+            rank_index.remove(user_id)
+
+        self.invalidate_role_counts()
+
+    def get_role_counts(self, branch: Union[LevelingRoute, str]) -> dict:
+        """
+        Get how many users with points on a branch have each role, counted with a single aggregation and cached
+        until roles change.
+
+        Parameters
+        ----------------
+        branch: Union[:class:`str`, :class:`LevelingRoute`]
+            The branch, if :class:`str`, only the first letter is used.
+
+        Returns
+        -------
+        :class:`dict`
+            Number of users keyed by role name, roles nobody has aren't included.
+        """
+        prefix = branch[0] if type(branch) == str else branch.name[0]
+        if prefix not in self.role_counts:
+            # buffered roles and points need to be counted too
+            write_buffer.flush()
+            role_counts = db.leveling_users.aggregate(
+                [
+                    {"$match": {"guild_id": self.id, f"{prefix}p": {"$gt": 0}}},
+                    {"$group": {"_id": f"${prefix}_role", "count": {"$sum": 1}}},
+                ]
+            )
+            self.role_counts[prefix] = {rc["_id"]: rc["count"] for rc in role_counts}
+
+        return self.role_counts[prefix]
+
+    def invalidate_role_counts(self, branch: Union[LevelingRoute, str] = None):
+        """
+        Clear cached role counts.
+
+        Parameters
+        ----------------
+        branch: Optional[Union[:class:`str`, :class:`LevelingRoute`]]
+            The branch whose counts will be cleared, if not set, counts of all branches are cleared.
+        """
+        if branch is None:
+            self.role_counts = {}
+            return
+
+        prefix = branch[0] if type(branch) == str else branch.name[0]
+        self.role_counts.pop(prefix, None)
+
+    async def reconcile_levels(
+        self, *, dry_run: bool = False, batch_size: int = 5000
+    ) -> dict:
+        """
+        Recalculate the level and role of every user in the guild from their points and fix the ones that differ.
+
+        Users are streamed from the database in batches and levels and roles are calculated for a whole batch at once
+        in an executor. The differences are then written with bulk_write from the event loop, only for users whose
+        points haven't changed since they were read, and cached members are updated with them.
+        Users with 0 points on a branch are left alone on it.
+
+        Parameters
+        ----------------
+        dry_run: :class:`bool`
+            If True, changes will only be counted and not written to the database.
+        batch_size: :class:`int`
+            How many users are processed at once.
+
+        Returns
+        -------
+        :class:`dict`
+            Report of the reconciliation, how many users were checked, how many users changed and how many times
+            each field changed.
+        """
+        # buffered points need to be in the database before they're read
+        write_buffer.flush()
+
+        report, updates = await asyncio.get_event_loop().run_in_executor(
+            None, self._reconcile_levels, batch_size
+        )
+
+        if not dry_run:
+            self._apply_reconciliation(updates, report)
+
+        return report
+
+    def _reconcile_levels(self, batch_size: int) -> Tuple[dict, list]:
+        """
+        Blocking part of :func:`reconcile_levels`, run in an executor.
+        Only reads from the database, returns the report and (points when read, user id, fields to set) of the users
+        whose levels or roles differ.
+        """
+        prefixes = [branch.name[0] for branch in self.leveling_routes]
+        report = {
+            "users": 0,
+            "changed_users": 0,
+            "changes": {
+                f"{prefix}_{field}": 0
+                for prefix in prefixes
+                for field in ("level", "role")
+            },
+        }
+        updates = []
+
+        fields = {"user_id": 1}
+        for prefix in prefixes:
+            fields.update({f"{prefix}p": 1, f"{prefix}_level": 1, f"{prefix}_role": 1})
+
+        leveling_users = db.leveling_users.find(
+            {"guild_id": self.id}, fields, batch_size=batch_size
+        )
+
+        batch = []
+        for leveling_user in leveling_users:
+            batch.append(leveling_user)
+            if len(batch) >= batch_size:
+                updates += self._reconcile_batch(batch, report)
+                batch = []
+
+        if batch:
+            updates += self._reconcile_batch(batch, report)
+
+        return report, updates
+
+    def _reconcile_batch(self, leveling_users: list, report: dict) -> list:
+        """Calculates the correct levels and roles for a batch of users and returns the ones that differ."""
+        updates = {}
+        for branch in self.leveling_routes:
+            prefix = branch.name[0]
+
+            points = numpy.array([u.get(f"{prefix}p", 0) for u in leveling_users])
+            stored_levels = numpy.array(
+                [u.get(f"{prefix}_level", 0) for u in leveling_users]
+            )
+            levels = level_curve.levels_from_points(points)
+            changed_levels = (points > 0) & (levels != stored_levels)
+
+            changed_roles = numpy.zeros(len(leveling_users), dtype=bool)
+            if branch.roles:
+                # every 5 levels user advances a role, see LevelingMember.user_role_level
+                role_names = numpy.array([r.name for r in branch.roles], dtype=object)
+                role_indexes = numpy.clip((levels + 4) // 5 - 1, 0, len(role_names) - 1)
+                roles = role_names[role_indexes]
+                stored_roles = numpy.array(
+                    [u.get(f"{prefix}_role") for u in leveling_users], dtype=object
+                )
+                changed_roles = (points > 0) & (roles != stored_roles)
+
+            for i in numpy.flatnonzero(changed_levels):
+                updates.setdefault(i, {})[f"{prefix}_level"] = int(levels[i])
+            for i in numpy.flatnonzero(changed_roles):
+                updates.setdefault(i, {})[f"{prefix}_role"] = roles[i]
+
+            report["changes"][f"{prefix}_level"] += int(changed_levels.sum())
+            report["changes"][f"{prefix}_role"] += int(changed_roles.sum())
+
+        report["users"] += len(leveling_users)
+        report["changed_users"] += len(updates)
+
+        reconciled = []
+        for i, fields in updates.items():
+            leveling_user = leveling_users[i]
+            # points of the branches whose level or role changes, used to check the user hasn't changed since
+            points = {
+                f"{key[0]}p": leveling_user.get(f"{key[0]}p", 0) for key in fields
+            }
+            reconciled.append((points, leveling_user["user_id"], fields))
+
+        return reconciled
+
+    def _apply_reconciliation(self, updates: list, report: dict):
+        """
+        Write the results of :func:`_reconcile_levels` and update cached members with them, runs on the event loop,
+        so the write buffer and cached members can't change in the meantime.
+        Users whose points changed after they were read are skipped, their levels were calculated from old points.
+        """
+        # changes made while users were being read need to be in the database for the points to be compared
+        write_buffer.flush()
+
+        requests = []
+        report["skipped_users"] = 0
+        for points, user_id, fields in updates:
+            leveling_member = self.members.peek(user_id)
+            if leveling_member is not None:
+                branches = {
+                    f"{branch.name[0]}p": getattr(leveling_member, branch.name)
+                    for branch in self.leveling_routes
+                }
+                if any(branches[key].points != value for key, value in points.items()):
+                    report["skipped_users"] += 1
+                    continue
+
+                # the values are written below, so they're set without going through the write buffer
+                for key, value in fields.items():
+                    branch = branches[f"{key[0]}p"]
+                    branch.__dict__[key[2:]] = value
+
+            requests.append(
+                UpdateOne(
+                    {"guild_id": self.id, "user_id": user_id, **points},
+                    {"$set": fields},
+                )
+            )
+
+        if requests:
+            result = db.leveling_users.bulk_write(requests, ordered=False)
+            report["skipped_users"] += len(requests) - result.matched_count
+
+        self.invalidate_role_counts()
+
+    def get_leaderboard(self, key: str) -> LeaderboardSnapshot:
+        """
+        Get the leaderboard of a points key, a new snapshot is only made if the index has changed and the
+        current snapshot is older than :attr:`leaderboard_ttl`.
+
+        Parameters
+        ----------------
+        key: :class:`str`
+            The points key, pp, hp or rp.
+
+        Returns
+        -------
+        :class:`LeaderboardSnapshot`
+            The leaderboard snapshot.
+        """
+        rank_index = self.rank_indexes[key]
+        snapshot = self.leaderboards.get(key)
+        if snapshot is None or (
+            snapshot.version != rank_index.version
+            and time.time() - snapshot.created_at > self.leaderboard_ttl
+        ):
+            snapshot = LeaderboardSnapshot(rank_index)
+            self.leaderboards[key] = snapshot
+
+        return snapshot
+
     def get_leveling_role(self, role_name: str) -> LevelingRole:
         """
         Get :class:`LevelingRole` by it's name.
@@ -753,12 +1551,8 @@ class LevelingGuild(LevelingData):
         Optional[:class:`LevelingRole`]
             The LevelingMember or `None` if member isn't in the guild.
         """
-        # try to get member from list of members
-        member = None
-        for _member in self.members:
-            if _member.id == member_id:
-                member = _member
-
+        # try to get member from cached members
+        member = self.members.get(member_id)
         if member is None:
             # try to get member from cache
             member = await get_member_by_id(self.guild, member_id)
@@ -786,17 +1580,19 @@ class LevelingGuild(LevelingData):
         leveling_member = LevelingMember(
             self.bot, self, member, leveling_user_data=leveling_user_data
         )
-        self.members.append(leveling_member)
+        self.members.add(leveling_member)
         return leveling_member
 
-    def get_level_up_channel(self, message: discord.Message) -> discord.TextChannel:
+    def get_level_up_channel(
+        self, channel: discord.abc.Messageable
+    ) -> discord.abc.Messageable:
         """
         Get level up channel for LevelingGuild.
 
         Parameters
         ----------------
-        message: :class:`discord.Message`
-            The discord message that will be used as a backup if LevelingGuild doesn't have a level_up_channel set.
+        channel: :class:`discord.abc.Messageable`
+            The channel the message was sent in, used as a backup if LevelingGuild doesn't have a level_up_channel set.
 
         Returns
         -------
@@ -804,12 +1600,12 @@ class LevelingGuild(LevelingData):
             The discord channel.
         """
         # get channel where to send level up message
-        channel = self.bot.get_channel(self.level_up_channel)
+        level_up_channel = self.bot.get_channel(self.level_up_channel)
         # if channel is none default to message channel
-        if channel is None:
-            channel = message.channel
+        if level_up_channel is None:
+            level_up_channel = channel
 
-        return channel
+        return level_up_channel
 
 
 class LevelingMember(LevelingUser):
@@ -847,8 +1643,18 @@ class LevelingMember(LevelingUser):
         if not leveling_user_data:
             leveling_user_data = db.get_leveling_user(member.guild.id, member.id)
 
+        # member might have been evicted from cache before their changes were written to the database
+        leveling_user_data = {
+            **leveling_user_data,
+            **write_buffer.get_pending(member.guild.id, member.id),
+        }
+
         super().__init__(self, leveling_user_data)
 
+        # users added to the database after the index was built
+        if self.id not in guild.rank_indexes["pp"]:
+            guild.index_user(leveling_user_data)
+
     async def add_points(self, branch: Union[LevelingRoute, str], amount: int) -> None:
         """
         Add points to a branch for LevelingMember.
@@ -863,13 +1669,9 @@ class LevelingMember(LevelingUser):
         """
         patreon_role_id = 644182117051400220
         member_role_id = 662036345526419486
-        if self.guild.automember and patreon_role_id not in [
-            r.id for r in self.member.roles
-        ]:
-            member_role = discord.utils.find(
-                lambda r: r.id == member_role_id, self.guild.guild.roles
-            )
-            await self.member.add_roles(member_role)
+        if self.guild.automember and self.member.get_role(patreon_role_id) is None:
+            member_role = self.guild.guild.get_role(member_role_id)
+            self.bot.leveling_system.role_assigner.add(self.member, member_role)
 
         if type(branch) == str:
             branch = self.guild.get_leveling_route(branch)
@@ -904,7 +1706,7 @@ class LevelingMember(LevelingUser):
         # get discord.Role role
         guild_role = await role.get_guild_role()
         # give role to user
-        await self.member.add_roles(guild_role)
+        self.bot.leveling_system.role_assigner.add(self.member, guild_role)
         return guild_role
 
     async def level_up(self, branch: LevelingRoute) -> Tuple[LevelingRole, int, int]:
@@ -930,15 +1732,14 @@ class LevelingMember(LevelingUser):
         # Checks if user has current role
         current_role = branch.find_role(user_branch.role)
         current_guild_role = await current_role.get_guild_role()
-        if current_guild_role not in self.member.roles:
-            await self.member.add_roles(current_guild_role)
+        self.bot.leveling_system.role_assigner.add(self.member, current_guild_role)
 
         # get user role level
         role_level = self.user_role_level(user_branch)
 
         # user needs to go up a role
         if role_level < 0:
-            role_index = branch.roles.index(current_role)
+            role_index = branch.role_position(current_role)
             new_role = (
                 branch.roles[-1]
                 if len(branch.roles) - 1 < role_index + abs(role_level)
@@ -956,7 +1757,7 @@ class LevelingMember(LevelingUser):
 
     async def level_up_message(
         self,
-        message: discord.Message,
+        channel: discord.abc.Messageable,
         user_branch: LevelingUserBranch,
         current_role: discord.Role,
         roles_up: int,
@@ -966,8 +1767,8 @@ class LevelingMember(LevelingUser):
 
         Parameters
         ---------------
-        message: :class:`discord.Message`
-            The message which caused the level up, needed for :func:`get_level_up_channel`.
+        channel: :class:`discord.abc.Messageable`
+            The channel of the message which caused the level up, needed for :func:`get_level_up_channel`.
         user_branch: :class:`LevelingUserBranch`
             The branch which the user leveled up on.
         current_role: :class:`discord.Role`
@@ -995,7 +1796,7 @@ class LevelingMember(LevelingUser):
         content = f"<@{self.id}>" if self.settings.at_me else ""
 
         # get channel where to send level up message
-        channel = self.guild.get_level_up_channel(message)
+        channel = self.guild.get_level_up_channel(channel)
         await channel.send(embed=embed, content=content)
 
     @staticmethod
@@ -1021,7 +1822,7 @@ class LevelingMember(LevelingUser):
             return 0  # return 0 if user's current role isn't listen in the branch
 
         all_roles = branch.roles
-        role_index = all_roles.index(user_role)
+        role_index = branch.role_position(user_role)
 
         # + 1 includes current role
         up_to_current_role = all_roles[: role_index + 1]
@@ -1068,24 +1869,7 @@ class LevelingMember(LevelingUser):
         :class:`int`
             The number of levels LevelingMember needs to go up.
         """
-        user_levels = user_branch.level
-        user_points = user_branch.points
-
-        total_points = 0
-        total_levels_up = 0
-        while total_points <= user_points:
-            next_level = user_levels + total_levels_up + 1
-            # total points needed to gain the next level
-            total_points = round(
-                5
-                / 6
-                * next_level
-                * (2 * next_level * next_level + 27 * next_level + 91)
-            )
-
-            total_levels_up += 1
-
-        return total_levels_up - 1
+        return level_curve.levels_up(user_branch.level, user_branch.points)
 
     async def notify_perks(self, role: LevelingRole):
         """
@@ -1132,19 +1916,11 @@ class LevelingMember(LevelingUser):
             The rank of LevelingMember in user branch.
         """
         key = f"{user_branch.branch.name[0]}p"
-        sorted_users = [
-            u
-            for u in db.leveling_users.find(
-                {
-                    "guild_id": self.guild.id,
-                    key: {
-                        "$gt": user_branch.points - 0.1
-                    },  # 0.1 is subtracted so member will be included
-                }
-            ).sort(key, -1)
-        ]
+        rank_index = self.guild.rank_indexes[key]
+        # points in the index are always up to date, unlike reputation.points
+        points = rank_index.points.get(self.id, user_branch.points)
 
-        return len(sorted_users)
+        return rank_index.rank(points)
 
     @staticmethod
     def percent_till_next_level(user_branch: LevelingUserBranch) -> float:
@@ -1161,22 +1937,10 @@ class LevelingMember(LevelingUser):
         :class:`float`
             The percent number, with one decimal point of how close user is to leveling up
         """
-        # points needed to gain next level from beginning of user level
-        points_to_level_up = 5 * (user_branch.level**2) + 50 * user_branch.level + 100
-
-        next_level = user_branch.level + 1
-        # total points needed to gain next level
-        total_points_to_next_level = round(
-            5 / 6 * next_level * (2 * next_level * next_level + 27 * next_level + 91)
-        )
-        points_needed = total_points_to_next_level - int(user_branch.points)
-
-        percent = (
-            math.floor((100 - ((points_needed * 100) / points_to_level_up)) * 10) / 10
+        return level_curve.percent_till_next_level(
+            user_branch.level, user_branch.points
         )
 
-        return percent
-
 
 class LevelingSystem:
     """
@@ -1188,21 +1952,56 @@ class LevelingSystem:
     ---------------
     bot: :class:`TLDR`
         The bot instance.
-    guilds: :class:`List[:class:`LevelingGuild`]`
-        List of the LevelingGuilds attached to the bot.
+    guilds: :class:`Dict[:class:`int`, :class:`LevelingGuild`]`
+        The LevelingGuilds attached to the bot, keyed by guild id.
+    xp_queues: :class:`List[:class:`asyncio.Queue`]`
+        Queues of (guild_id, author_id, channel_id, timestamp) messages waiting to be processed for XP.
+        Messages of a member always go to the same queue, so a member is only processed by one worker at a time.
+    xp_lag: :class:`float`
+        Seconds the last processed message waited in the queue.
     """
 
+    # number of XP workers, max messages in each of their queues and how many messages a worker takes at once
+    xp_workers = 4
+    xp_queue_size = 1000
+    xp_batch_size = 50
+
     def __init__(self, bot):
         self.bot = bot
-        # list of leveling guilds
-        self.guilds = []
+        # leveling guilds by their id
+        self.guilds = {}
+        self.write_buffer = write_buffer
+        self.role_assigner = RoleAssigner(bot)
+        self.role_assigner_task = None
+        self.xp_queues = [
+            asyncio.Queue(maxsize=self.xp_queue_size) for _ in range(self.xp_workers)
+        ]
+        self.xp_worker_tasks = []
+        self.xp_lag = 0.0
         self.bot.add_listener(self.on_message, "on_message")
         self.bot.add_listener(self.on_ready, "on_ready")
+        self.bot.add_listener(self.role_assigner.on_member_update, "on_member_update")
         self.bot.logger.info("LevelingSystem module has been initiated")
 
     async def on_ready(self):
         await self.initialise_guilds()
         await self.check_left_members()
+        self.flush_write_buffer.start()
+        if self.role_assigner_task is None:
+            self.role_assigner_task = self.bot.loop.create_task(
+                self.role_assigner.run()
+            )
+
+        if not self.xp_worker_tasks:
+            self.xp_worker_tasks = [
+                self.bot.loop.create_task(self.xp_worker(queue))
+                for queue in self.xp_queues
+            ]
+
+    @timers.loop(seconds=5)
+    async def flush_write_buffer(self):
+        """Periodically writes buffered leveling_users changes to the database."""
+        self.write_buffer.flush()
 
     async def check_left_members(self):
         self.bot.logger.info(f"Checking Guilds for left members.")
@@ -1235,19 +2034,19 @@ class LevelingSystem:
         )
 
     def transfer_leveling_data(self, leveling_user: dict):
+        leveling_guild = self.get_guild(leveling_user["guild_id"])
+        if leveling_guild:
+            leveling_guild.unindex_user(leveling_user["user_id"])
+            leveling_guild.members.remove(leveling_user["user_id"])
+
+        self.role_assigner.forget(leveling_user["guild_id"], leveling_user["user_id"])
+
         db.leveling_users.delete_many(leveling_user)
         db.left_leveling_users.delete_many(leveling_user)
+        # the TTL index on expires_at deletes the data once it expires
+        leveling_user["expires_at"] = datetime.utcnow() + database.left_data_lifetime
         db.left_leveling_users.insert_one(leveling_user)
 
-        data_expires = round(time.time()) + 30 * 24 * 60 * 60  # 30 days
-
-        self.bot.timers.create(
-            guild_id=leveling_user["guild_id"],
-            expires=data_expires,
-            event="leveling_data_expires",
-            extras={"user_id": leveling_user["user_id"]},
-        )
-
     async def on_message(self, message: discord.Message):
         """Function called on every message to level up members."""
         if not self.bot._ready.is_set():
@@ -1264,9 +2063,52 @@ class LevelingSystem:
         ):
             return
 
-        print(f"Message from {message.author.name}: {message.content}")
-        leveling_cog = self.bot.get_cog("Leveling")
-        await leveling_cog.process_message(message)
+        # when queues are full, this waits without blocking other events and xp is given late
+        queue = self.xp_queues[message.author.id % self.xp_workers]
+        await queue.put(
+            (message.guild.id, message.author.id, message.channel.id, time.time())
+        )
+
+    async def xp_worker(self, queue: asyncio.Queue):
+        """Processes messages from an XP queue in batches."""
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.xp_batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            leveling_cog = self.bot.get_cog("Leveling")
+            # messages sent while the leveling cog isn't loaded don't give xp
+            if leveling_cog is None:
+                continue
+
+            for guild_id, author_id, channel_id, timestamp in batch:
+                self.xp_lag = time.time() - timestamp
+                try:
+                    await leveling_cog.process_message(
+                        guild_id, author_id, channel_id, timestamp
+                    )
+                except Exception as e:
+                    # the worker has to keep running, even if reporting the error fails
+                    try:
+                        await self.bot.on_event_error(e, "xp_worker", loop=True)
+                    except Exception:
+                        self.bot.logger.exception(
+                            f"Failed to give xp to {author_id} in {guild_id}"
+                        )
+
+    def xp_queue_stats(self) -> dict:
+        """
+        Get the state of the XP queues.
+
+        Returns
+        -------
+        :class:`dict`
+            Number of messages waiting in the queues and lag of the last processed message in seconds.
+        """
+        return {
+            "depth": sum(queue.qsize() for queue in self.xp_queues),
+            "lag": self.xp_lag,
+        }
 
     async def initialise_guilds(self):
         """Function called in :func:`cogs.events.on_ready` to initialise all the guilds and cache them."""
@@ -1310,9 +2152,7 @@ class LevelingSystem:
         :class:`LevelingGuild`
             The LevelingGuild or `None` if the LevelingGuild isn't found.
         """
-        for guild in self.guilds:
-            if guild.id == guild_id:
-                return guild
+        return self.guilds.get(guild_id)
 
     def add_guild(self, guild: discord.Guild) -> LevelingGuild:
         """
@@ -1332,5 +2172,5 @@ class LevelingSystem:
             f"Adding guild {guild.name} [{guild.id}] to LevelingSystem."
         )
         leveling_guild = LevelingGuild(self.bot, guild)
-        self.guilds.append(leveling_guild)
+        self.guilds[leveling_guild.id] = leveling_guild
         return leveling_guild
@@ -31,7 +31,7 @@ from pymongo.collection import Collection
 import modules.database as database
 import modules.format_time as format_time
 from modules import database, embed_maker
-from discord.ext.tasks import loop
+from modules.timers import loop
 from modules.utils import SettingsHandler
 
 db = database.get_connection()
@@ -12,13 +12,13 @@ from cachetools.ttl import TTLCache
 from discord import ButtonStyle, Interaction, Member, Message, Thread, threads
 from discord.channel import TextChannel
 from discord.ext.commands import Context
-from discord.ext.tasks import loop
 from discord.ui import Button, View, button
 from pymongo.collection import Collection
 
 import modules.database as database
 import modules.embed_maker as embed_maker
 import modules.format_time as format_time
+from modules.timers import loop
 from modules.utils import SettingsHandler
 
 # TODO: Setup cooldowns according to the perks a user had (cooldown between creating threadpolls.
@@ -1,74 +1,284 @@
 import asyncio
+import heapq
+import itertools
+import logging
+import math
 import time
+from typing import Optional
 
 from bson import ObjectId
 from discord.ext.commands import Bot
 
 from modules import database
 
+logger = logging.getLogger("TLDR")
+
 db = database.get_connection()
+async_db = database.get_async_connection()
+
+
+class Ticker:
+    """
+    Shared scheduler of all the :class:`Loop` objects.
+    A single task keeps the next deadline of every running loop in a min-heap and sleeps until the earliest one,
+    deadlines are aligned to multiples of the loop's period on the monotonic clock, so loops with the same period
+    are all run on the same wakeup.
+
+    Attributes
+    ---------------
+    heap: :class:`list`
+        Min-heap of (deadline, sequence number, loop generation, loop).
+    counter: :class:`itertools.count`
+        Sequence numbers of heap entries, so loops are never compared.
+    wakeup: Optional[:class:`asyncio.Event`]
+        Set to wake up the ticker when a loop is added to the front of :attr:`heap`.
+    task: Optional[:class:`asyncio.Task`]
+        The ticker task, started when the first loop is scheduled.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+
+    def schedule(self, loop: "Loop"):
+        """Add the next deadline of a loop to :attr:`heap`."""
+        entry = (loop.deadline, next(self.counter), loop.generation, loop)
+        heapq.heappush(self.heap, entry)
+
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_event_loop().create_task(self.run())
+        elif self.heap[0] is entry:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                _, _, generation, loop = heapq.heappop(self.heap)
+                # entries of stopped or restarted loops are dropped
+                if loop.running and loop.generation == generation:
+                    loop.tick(now)
+
+            timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+ticker = Ticker()
 
 
 class Loop:
-    def __init__(self, coro, seconds, minutes, hours):
+    """
+    Runs a coroutine every :attr:`time` seconds, scheduled by :data:`ticker`.
+
+    Runs are started at deadlines aligned to the monotonic clock, so the period doesn't drift by the runtime of the
+    coroutine. If the previous run hasn't finished by the next deadline, :attr:`overrun` decides what happens:
+    `skip` drops the run, `queue` runs it after the previous one finishes and `coalesce` queues at most one run.
+
+    When used on a method, every instance gets its own loop.
+
+    Attributes
+    ---------------
+    coro: :class:`Callable`
+        The coroutine function.
+    time: :class:`float`
+        Period of the loop in seconds.
+    overrun: :class:`str`
+        The overrun policy, `skip`, `queue` or `coalesce`.
+    running: :class:`bool`
+        True if the loop has been started.
+    deadline: Optional[:class:`float`]
+        Monotonic time of the next run.
+    generation: :class:`int`
+        Incremented every time the loop is started, so deadlines from before a restart are ignored.
+    task: Optional[:class:`asyncio.Task`]
+        Task of the current run.
+    pending: :class:`int`
+        Runs queued while the current run is going.
+    runs: :class:`int`
+        Number of times the coroutine has been run.
+    skipped: :class:`int`
+        Number of deadlines that were skipped because of overruns.
+    last_runtime: :class:`float`
+        Runtime of the last run in seconds.
+    max_runtime: :class:`float`
+        Longest runtime in seconds.
+    total_runtime: :class:`float`
+        Runtime of all the runs in seconds.
+    last_lag: :class:`float`
+        Seconds between the deadline and the start of the last run.
+    max_lag: :class:`float`
+        Biggest lag in seconds.
+    """
+
+    overrun_policies = ("skip", "queue", "coalesce")
+
+    def __init__(self, coro, seconds, minutes, hours, *, overrun="skip", injected=None):
+        if overrun not in self.overrun_policies:
+            raise ValueError(f"Invalid overrun policy: {overrun}")
+
         self.coro = coro
-        self._injected = None
+        self.name = coro.__name__
+        self._injected = injected
 
         self.seconds = seconds
         self.minutes = minutes
         self.hours = hours
         self.time = seconds + (minutes * 60) + (hours * 60 * 60)
-
-        self.started = asyncio.Event()
-        self.loop = asyncio.get_event_loop()
-        self.loop.create_task(self.run_loop())
+        self.overrun = overrun
+
+        self.running = False
+        self.deadline = None
+        self.generation = 0
+        self.task = None
+        self.pending = 0
+
+        self.runs = 0
+        self.skipped = 0
+        self.last_runtime = 0
+        self.max_runtime = 0
+        self.total_runtime = 0
+        self.last_lag = 0
+        self.max_lag = 0
 
     def start(self):
-        self.started.set()
+        if self.running:
+            return
+
+        self.running = True
+        self.generation += 1
+        # first run is at least one period away, like it would be with a sleep
+        self.deadline = (
+            math.ceil((time.monotonic() + self.time) / self.time) * self.time
+        )
+        ticker.schedule(self)
 
     def stop(self):
-        self.started.clear()
+        self.running = False
+        self.pending = 0
 
     def is_running(self):
-        return self.started.is_set()
+        return self.running
+
+    def __set_name__(self, owner, name):
+        self.name = name
 
     def __get__(self, obj, objtype):
         if obj is None:
             return self
 
-        self._injected = obj
-        return self
+        # bind a copy of the loop to the instance, the instance attribute is found before this descriptor after that
+        bound = Loop(
+            self.coro,
+            self.seconds,
+            self.minutes,
+            self.hours,
+            overrun=self.overrun,
+            injected=obj,
+        )
+        bound.name = self.name
+        obj.__dict__[self.name] = bound
+        return bound
+
+    def tick(self, now: float):
+        """
+        Called by :data:`ticker` when the deadline has been reached, starts a run and schedules the next deadline.
 
-    async def run_loop(self):
-        print(self.started.is_set())
-        await self.started.wait()
+        Parameters
+        ----------------
+        now: :class:`float`
+            Current monotonic time.
+        """
+        if self.task and not self.task.done():
+            if self.overrun == "queue":
+                self.pending += 1
+            elif self.overrun == "coalesce":
+                self.pending = 1
+            else:
+                self.skipped += 1
+        else:
+            self.last_lag = now - self.deadline
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+        # deadlines missed while the event loop was blocked are skipped
+        missed = math.floor((now - self.deadline) / self.time)
+        self.skipped += missed
+        self.deadline += (missed + 1) * self.time
+        ticker.schedule(self)
+
+    async def run(self):
+        """Run the coroutine, followed by the runs that were queued while it was running."""
         while True:
-            await asyncio.sleep(self.time)
-
-            # if loop is stopped return to waiting
-            if not self.started.is_set() or not self.loop.is_running():
-                return await self.run_loop()
-
+            start = time.monotonic()
             try:
                 await self.coro(self._injected)
             except Exception as e:
-                if hasattr(self._injected, "bot"):
-                    await self._injected.bot.on_event_error(
-                        e, self.coro.__name__, loop=True
-                    )
-                if isinstance(self._injected, Bot):
-                    # checking if isinstace bot, cause can't import TLDR due to circular import
-                    await self._injected.on_event_error(
-                        e, self.coro.__name__, loop=True
-                    )
-
-
-def loop(*, seconds=0, minutes=0, hours=0):
+                await self.report_error(e)
+
+            runtime = time.monotonic() - start
+            self.runs += 1
+            self.last_runtime = runtime
+            self.max_runtime = max(self.max_runtime, runtime)
+            self.total_runtime += runtime
+
+            if not self.pending or not self.running:
+                return
+
+            self.pending -= 1
+
+    async def report_error(self, e: Exception):
+        """Report an error to the bot of the loop's owner, or log it if the owner doesn't have a bot."""
+        # checking if isinstace bot, cause can't import TLDR due to circular import
+        if isinstance(self._injected, Bot):
+            bot = self._injected
+        else:
+            bot = getattr(self._injected, "bot", None) or getattr(
+                self._injected, "_bot", None
+            )
+
+        if isinstance(bot, Bot):
+            await bot.on_event_error(e, self.coro.__name__, loop=True)
+        else:
+            logger.error(
+                f"Exception in loop {self.coro.__qualname__}",
+                exc_info=(type(e), e, e.__traceback__),
+            )
+
+    def stats(self) -> dict:
+        """
+        Get runtime and lag statistics of the loop.
+
+        Returns
+        -------
+        :class:`dict`
+            Dict with runs, skipped, last_runtime, max_runtime, average_runtime, last_lag and max_lag keys,
+            times are in seconds.
+        """
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "last_runtime": self.last_runtime,
+            "max_runtime": self.max_runtime,
+            "average_runtime": self.total_runtime / self.runs if self.runs else 0,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+
+def loop(*, seconds=0, minutes=0, hours=0, overrun="skip"):
     def decorator(func):
         kwargs = {
             "seconds": seconds,
             "minutes": minutes,
             "hours": hours,
+            "overrun": overrun,
         }
         return Loop(func, **kwargs)
 
@@ -78,74 +288,334 @@ def loop(*, seconds=0, minutes=0, hours=0):
 class Timers:
     """
     Class for implementing functions with timed calls.
-    Functions will be called by dispatching bot events by the name `on_{event}_timer_over`.
+    Listeners with the name `on_{event}_timer_over` are called with the timer when it expires.
+
+    The timer stays in the database, claimed by this process, while its listeners run and is deleted once they have
+    all finished, so a listener that queries or updates its own timer will still find it. Listeners that create a new
+    timer for the same thing should make sure updates aimed at the old timer don't match it, e.g. by filtering out
+    claimed timers with `{"claimed_by": {"$exists": False}}`.
+
+    Timers are run by a single scheduler task, which keeps the timers that expire within :attr:`window` seconds
+    in a min-heap and sleeps until the earliest one expires.
 
     Attributes
     ---------------
     bot: :class:`bot.TLDR`
         The discord bot.
+    heap: :class:`list`
+        Min-heap of (expires, timer id, timer) of the timers that expire before :attr:`window_end`.
+    scheduled: :class:`set`
+        IDs of the timers in :attr:`heap`.
+    window_end: :class:`float`
+        Timers that expire before this have been loaded from the database.
+    next_lease_check: :class:`float`
+        When the database will next be checked for timers whose claim has run out.
+    wakeup: :class:`asyncio.Event`
+        Set to wake up the scheduler when a timer is added to the front of :attr:`heap`.
+    scheduler_task: Optional[:class:`asyncio.Task`]
+        The scheduler task.
+    poll_messages: :class:`dict`
+        IDs of the timers of active polls, keyed by the ID of the poll message, so reactions on other messages
+        don't need to query the database.
+    dm_polls: :class:`dict`
+        Message IDs of the polls sent to users in DMs, keyed by (main poll message ID, user ID).
+    running: :class:`dict`
+        Claim IDs of the timers whose listeners are running, keyed by timer ID.
     """
 
+    # how many seconds ahead timers are loaded from the database
+    window = 3600
+    # max number of timers claimed and dispatched at once
+    batch_size = 100
+    # seconds after which a timer that was claimed but never deleted, because of a crash, can be claimed again
+    lease_time = 300
+    # how often, in seconds, the database is checked for timers whose claim has run out
+    lease_check_interval = 60
+    # events of timers that are tied to a poll message
+    poll_events = ("anon_poll", "delete_temp_poll")
+
     def __init__(self, bot):
         self.bot = bot
+        self.heap = []
+        self.scheduled = set()
+        self.window_end = 0
+        self.next_lease_check = 0
+        self.wakeup = asyncio.Event()
+        self.scheduler_task = None
+        self.poll_messages = {}
+        self.dm_polls = {}
+        self.running = {}
+        self.index_polls()
         self.bot.add_listener(self.on_ready, "on_ready")
         self.bot.logger.info("Timers module has been initiated")
 
     async def on_ready(self):
-        await self.run_old()
+        if self.scheduler_task is None:
+            self.scheduler_task = self.bot.loop.create_task(self.scheduler())
+
+    def index_polls(self) -> None:
+        """Load the message IDs of all the active polls into :attr:`poll_messages` and :attr:`dm_polls`."""
+        timers = db.timers.find(
+            {"event": {"$in": self.poll_events}},
+            {
+                "event": 1,
+                "extras.message_id": 1,
+                "extras.main_poll_id": 1,
+                "extras.user_id": 1,
+            },
+        )
+        for timer in timers:
+            self.index_timer(timer)
 
-    async def run_loop(self, loop: Loop):
-        await loop.started.wait()
-        while True:
-            # if loop is stopped return
-            if not loop.started.is_set():
-                return self.run_loop(loop)
+    def index_timer(self, timer: dict) -> None:
+        """
+        Add a timer to :attr:`poll_messages` and :attr:`dm_polls` if it's tied to a poll message.
 
-            await asyncio.sleep(loop.time)
-            await loop.coro()
+        Parameters
+        ----------------
+        timer: :class:`dict`
+            Timer dictionary from :func:`create`
+        """
+        extras = timer.get("extras") or {}
+        if timer["event"] not in self.poll_events or "message_id" not in extras:
+            return
 
-    async def run_old(self) -> None:
-        """Runs all the timers that were cut short, that are still in the database."""
-        await self.bot.left_check.wait()
+        self.poll_messages[extras["message_id"]] = str(timer["_id"])
+        if "main_poll_id" in extras:
+            key = (extras["main_poll_id"], extras["user_id"])
+            self.dm_polls[key] = extras["message_id"]
 
-        timers = db.timers.find({})
-        self.bot.logger.info(f"Running {timers.count()} old timers.")
+    def unindex_timer(self, timer: dict) -> None:
+        """
+        Remove a timer from :attr:`poll_messages` and :attr:`dm_polls`, should be called when a poll timer is deleted.
 
+        Parameters
+        ----------------
+        timer: :class:`dict`
+            Timer dictionary from :func:`create`
+        """
+        extras = timer.get("extras") or {}
+        message_id = extras.get("message_id")
+        # the message might already belong to a newer timer of the same poll
+        if self.poll_messages.get(message_id) != str(timer["_id"]):
+            return
+
+        del self.poll_messages[message_id]
+        if "main_poll_id" in extras:
+            key = (extras["main_poll_id"], extras["user_id"])
+            if self.dm_polls.get(key) == message_id:
+                del self.dm_polls[key]
+
+    def get_poll_timer(self, message_id: int) -> Optional[dict]:
+        """
+        Get the timer of a poll message.
+
+        Parameters
+        ----------------
+        message_id: :class:`int`
+            ID of the poll message.
+
+        Returns
+        -------
+        Optional[:class:`dict`]
+            The timer or None if the message isn't an active poll.
+        """
+        timer_id = self.poll_messages.get(message_id)
+        if timer_id is None:
+            return None
+
+        return db.timers.find_one({"_id": ObjectId(timer_id)})
+
+    async def load_window(self, now: float) -> None:
+        """
+        Move the window forward and add the timers that expire in the new part of it to :attr:`heap`.
+        On the first load, this includes all the timers that were cut short and are still in the database.
+
+        Parameters
+        ----------------
+        now: :class:`float`
+            The current time.
+        """
+        window_end = now + self.window
+        query = {"expires": {"$lte": window_end}}
+        if self.window_end:
+            query["expires"]["$gt"] = self.window_end
+
+        # set before the query, so timers created while it runs are scheduled by create
+        self.window_end = window_end
+        timers = await async_db.timers.find(query)
+
+        count = 0
         for timer in timers:
-            asyncio.create_task(self.run(timer))
+            self.schedule(timer)
+            count += 1
 
-    async def run(self, timer) -> None:
+        self.bot.logger.debug(f"Loaded {count} timers into the scheduler.")
+
+    async def load_expired_claims(self, now: float) -> None:
         """
-        Runs a timer, by sleeping until the timer expires.
+        Renew the claims of the timers whose listeners are still running and add the timers whose claim has run out
+        to :attr:`heap`, so they will be retried.
+        These are timers whose events didn't finish, because the process that claimed them stopped.
+
+        Parameters
+        ----------------
+        now: :class:`float`
+            The current time.
+        """
+        self.next_lease_check = now + self.lease_check_interval
+        if self.running:
+            await async_db.timers.update_many(
+                {
+                    "_id": {"$in": [ObjectId(timer_id) for timer_id in self.running]},
+                    "claimed_by": {"$in": list(set(self.running.values()))},
+                },
+                {"$set": {"claimed_at": now}},
+            )
+
+        timers = await async_db.timers.find(
+            {"claimed_at": {"$lte": now - self.lease_time}}
+        )
+        for timer in timers:
+            # listeners that are still running in this process aren't called again
+            if str(timer["_id"]) not in self.running:
+                self.schedule(timer)
+
+    def schedule(self, timer: dict) -> None:
+        """
+        Add a timer to :attr:`heap` and wake up the scheduler if it's now the earliest timer.
 
         Parameters
         ----------------
         timer: :class:`dict`
             Timer dictionary from :func:`create`
         """
-        now = round(time.time())
+        timer_id = str(timer["_id"])
+        if timer_id in self.scheduled:
+            return
 
-        if timer["expires"] > now:
-            await asyncio.sleep(timer["expires"] - now)
+        self.scheduled.add(timer_id)
+        heapq.heappush(self.heap, (timer["expires"], timer_id, timer))
+        if self.heap[0][1] == timer_id:
+            self.wakeup.set()
 
-        self.call_event(timer)
+    async def scheduler(self) -> None:
+        """Sleeps until the earliest timer expires and calls the events of all the expired timers in batches."""
+        await self.bot.left_check.wait()
+        self.bot.logger.info("Timer scheduler has started.")
+
+        while True:
+            now = time.time()
+            # load the next part of the window before the loaded part runs out
+            if now >= self.window_end - self.window / 2:
+                await self.load_window(now)
+            if now >= self.next_lease_check:
+                await self.load_expired_claims(now)
+
+            due = []
+            while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+                _, timer_id, timer = heapq.heappop(self.heap)
+                self.scheduled.discard(timer_id)
+                due.append(timer)
+
+            if due:
+                await self.call_events(due)
+
+                # let other tasks run between batches
+                await asyncio.sleep(0)
+                continue
+
+            next_wakeup = min(self.window_end - self.window / 2, self.next_lease_check)
+            if self.heap:
+                next_wakeup = min(self.heap[0][0], next_wakeup)
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(next_wakeup - now, 0))
+            except asyncio.TimeoutError:
+                pass
 
-    def call_event(self, timer) -> None:
+    async def call_events(self, timers: list) -> None:
         """
-        Call timer event.
-        Event will be dispatched with the name `on_{event}_timer_over`.
+        Claim timers and call their events.
+        Event handlers with the name `on_{event}_timer_over` will be called.
+
+        Timers are claimed atomically by setting claimed_by and claimed_at on the ones that haven't been claimed,
+        or whose claim has run out, so a timer is only dispatched once even if multiple processes run the timers.
+        A timer is deleted once the handlers of its event have finished, claims of timers whose handlers are still
+        running are renewed, claimed timers that are left in the database are retried after :attr:`lease_time`.
+
+        Parameters
+        ----------------
+        timers: :class:`list`
+            Timer dictionaries from :func:`create`
+        """
+        now = time.time()
+        claim_id = ObjectId()
+        await async_db.timers.update_many(
+            {
+                "_id": {"$in": [ObjectId(timer["_id"]) for timer in timers]},
+                "$or": [
+                    {"claimed_at": {"$exists": False}},
+                    {"claimed_at": {"$lte": now - self.lease_time}},
+                ],
+            },
+            {"$set": {"claimed_by": claim_id, "claimed_at": now}},
+        )
+
+        claimed = await async_db.timers.find({"claimed_by": claim_id})
+        if not claimed:
+            return
+
+        for timer in claimed:
+            del timer["claimed_by"], timer["claimed_at"]
+            self.unindex_timer(timer)
+            self.bot.loop.create_task(self.run_event(timer, claim_id))
+
+    async def run_event(self, timer: dict, claim_id: ObjectId) -> None:
+        """
+        Run the handlers of a claimed timer's event and delete the timer once they have finished.
+        Errors in handlers are reported and don't cause a retry, only timers whose handlers never finished are retried.
 
         Parameters
         ----------------
         timer: :class:`dict`
             Timer dictionary from :func:`create`
+        claim_id: :class:`bson.ObjectId`
+            ID of the claim the timer was claimed with.
         """
-        timer = db.timers.find_one({"_id": ObjectId(timer["_id"])})
-        if not timer:
-            return
+        event = f'on_{timer["event"]}_timer_over'
+        # same handlers bot.dispatch would schedule, awaited so the timer is only deleted after they're done
+        handlers = list(self.bot.extra_events.get(event, []))
+        if hasattr(self.bot, event):
+            handlers.append(getattr(self.bot, event))
+
+        timer_id = str(timer["_id"])
+        self.running[timer_id] = claim_id
+        try:
+            for handler in handlers:
+                try:
+                    await handler(timer)
+                except Exception as e:
+                    await self.bot.on_event_error(e, event, timer)
+
+            await async_db.timers.delete_one(
+                {"_id": timer["_id"], "claimed_by": claim_id}
+            )
+        finally:
+            del self.running[timer_id]
+
+    async def call_event(self, timer) -> None:
+        """
+        Call timer event.
+        Event handlers with the name `on_{event}_timer_over` will be called.
 
-        db.timers.delete_one({"_id": ObjectId(timer["_id"])})
-        self.bot.dispatch(f'{timer["event"]}_timer_over', timer)
+        Parameters
+        ----------------
+        timer: :class:`dict`
+            Timer dictionary from :func:`create`
+        """
+        await self.call_events([timer])
 
     def create(self, *, guild_id: int, expires: int, event: str, extras: dict):
         """
@@ -171,4 +641,8 @@ class Timers:
 
         result = db.timers.insert_one(timer_dict)
         timer_dict["_id"] = str(result.inserted_id)
-        asyncio.create_task(self.run(timer_dict))
+        self.index_timer(timer_dict)
+
+        # timers past the window will be loaded when the window reaches them
+        if expires <= self.window_end:
+            self.schedule(timer_dict)
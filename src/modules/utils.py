@@ -40,6 +40,7 @@ class SettingsHandler:
             )
 
         self._db.guild_settings.replace_one({"_id": new_settings["_id"]}, new_settings)
+        self._db.cache.invalidate("guild_settings", new_settings["guild_id"])
 
     def update(self, module_name: str, default_settings, guild_id: int):
         """
@@ -306,6 +307,62 @@ def get_custom_emote(ctx: Context, emote: str) -> Optional[discord.Emoji]:
     return result
 
 
+class RoleIndex:
+    """
+    Index of guild roles by their name, so roles don't need to be searched for in guild.roles.
+
+    Indexes are built when a guild's role is first looked up and are dropped when a role is created, deleted
+    or renamed, the bot is responsible for calling the listeners.
+
+    Attributes
+    ---------------
+    guilds: :class:`dict`
+        Roles keyed by name, keyed by guild id.
+    """
+
+    def __init__(self):
+        self.guilds = {}
+
+    def get(self, guild: discord.Guild, name: str) -> Optional[discord.Role]:
+        """
+        Get guild's role by its name.
+
+        Parameters
+        ----------------
+        guild: :class:`discord.Guild`
+            Guild where to search the role from.
+        name: :class:`str`
+            Name of the role.
+
+        Returns
+        -------
+        Optional[:class:`discord.Role`]
+            Role if one is found, otherwise `None`.
+        """
+        if guild.id not in self.guilds:
+            roles = {}
+            # if multiple roles have the same name, the lowest one is used, same as discord.utils.find
+            for role in guild.roles:
+                roles.setdefault(role.name, role)
+
+            self.guilds[guild.id] = roles
+
+        return self.guilds[guild.id].get(name)
+
+    async def on_guild_role_create(self, role: discord.Role):
+        self.guilds.pop(role.guild.id, None)
+
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if before.name != after.name or before.position != after.position:
+            self.guilds.pop(after.guild.id, None)
+
+    async def on_guild_role_delete(self, role: discord.Role):
+        self.guilds.pop(role.guild.id, None)
+
+
+role_index = RoleIndex()
+
+
 async def get_guild_role(
     guild: discord.Guild, role_identifier: str
 ) -> Optional[discord.Role]:
@@ -328,7 +385,7 @@ async def get_guild_role(
     if match:
         role = guild.get_role(int(match.group(1)))
     else:
-        role = discord.utils.find(lambda rl: rl.name == role_identifier, guild.roles)
+        role = role_index.get(guild, role_identifier)
 
     return role
 
@@ -6,15 +6,93 @@ import config
 import discord
 from bson import json_util
 from discord.enums import ChannelType
+from pymongo import UpdateOne
 
-from modules import database
-from modules.custom_commands import Role
+from modules import database, timers
+from modules.custom_commands import Role, uncombinable_pattern
 from modules.utils import SettingsHandler
 
 db = database.get_connection()
+async_db = database.get_async_connection()
+
+
+class WatchlistMatcher:
+    """
+    Matches messages against the filters of a watchlist member.
+
+    The filters are compiled once and combined into a single case-insensitive alternation,
+    so a message that doesn't match any filter is rejected with one regex scan.
+
+    Attributes
+    ---------------
+    filters: :class:`list`
+        (compiled regex, filter) of the member's filters, in the order they were added.
+    combined: Optional[:class:`re.Pattern`]
+        All the filters combined into one pattern, each in a named group, None if they couldn't be combined.
+    """
+
+    def __init__(self, filters: list):
+        self.filters = []
+        for filter in filters:
+            try:
+                self.filters.append(
+                    (re.compile(filter["regex"], re.IGNORECASE), filter)
+                )
+            except re.error:
+                continue
+
+        self.combined = None
+        # numbered references and global flags would change meaning in the combined pattern,
+        # filters that use them are matched one by one
+        if not self.filters or any(
+            uncombinable_pattern.search(p.pattern) for p, _ in self.filters
+        ):
+            return
+
+        try:
+            self.combined = re.compile(
+                "|".join(
+                    f"(?P<_wf{i}>{pattern.pattern})"
+                    for i, (pattern, _) in enumerate(self.filters)
+                ),
+                re.IGNORECASE,
+            )
+        except re.error:
+            pass
+
+    def match(self, content: str) -> Optional[dict]:
+        """
+        Find the first filter that matches the content.
+
+        Parameters
+        ----------------
+        content: :class:`str`
+            Content of a message.
+
+        Returns
+        -------
+        Optional[:class:`dict`]
+            The filter, if one matched.
+        """
+        candidates = self.filters
+        if self.combined is not None:
+            match = self.combined.search(content)
+            if match is None:
+                return None
+
+            # the filter that matched first in the message isn't necessarily the first filter that matches,
+            # so the filters before it are still checked
+            candidates = self.filters[: int(match.lastgroup[3:]) + 1]
+
+        return next((f for p, f in candidates if p.search(content) is not None), None)
 
 
 class Watchlist:
+    # discord allows up to 10 embeds, 6000 characters of embeds and 10 files in a message
+    max_embeds = 10
+    max_embeds_length = 6000
+    max_files = 10
+
     def __init__(self, bot):
         self.bot = bot
 
@@ -26,8 +104,22 @@ class Watchlist:
 
         self.members = {}
         self.watchlist_data = {}
+        # WatchlistMatcher of every watchlist member, keyed by guild id and user id, 0 is the generic filters
+        self.matchers = {}
+        # resolved watchlist category and channels keyed by (guild id, name)
+        # and threads of watchlist members keyed by (guild id, user id)
+        self.channels = {}
+        self.threads = {}
+        # watched messages waiting to be forwarded, keyed by (channel id, thread id)
+        self.forwards = {}
+        # filter matches that haven't been written to the database, keyed by (guild id, user id, regex)
+        self.matches = {}
         self.bot.add_listener(self.on_message, "on_message")
         self.bot.add_listener(self.on_ready, "on_ready")
+        self.bot.add_listener(self.forget_channel, "on_guild_channel_delete")
+        self.bot.add_listener(self.forget_channel, "on_guild_channel_update")
+        self.bot.add_listener(self.forget_channel, "on_thread_delete")
+        self.bot.add_listener(self.forget_channel, "on_thread_update")
         self._default_settings = {"roles": []}
         self._settings_handler: SettingsHandler = bot.settings_handler
         settings = self._settings_handler.get_settings(config.MAIN_SERVER)
@@ -68,6 +160,65 @@ class Watchlist:
 
     async def on_ready(self):
         await self.bot.watchlist.initialize()
+        self.flush_forwards.start()
+
+    @timers.loop(seconds=10)
+    async def flush_forwards(self):
+        """Periodically forwards the queued watchlist messages and writes the filter match counts."""
+        await self.flush()
+
+    async def flush(self):
+        """Forward all the queued watchlist messages and write the filter match counts."""
+        forwards, self.forwards = self.forwards, {}
+        for forward in forwards.values():
+            await self.forward(forward)
+
+        try:
+            await self.flush_matches()
+        except Exception as e:
+            await self.bot.on_event_error(e, "watchlist_flush_matches")
+
+    async def flush_matches(self):
+        """Write the buffered filter match counts to the database with one bulk_write."""
+        if not self.matches:
+            return
+
+        matches, self.matches = self.matches, {}
+        try:
+            await async_db.watchlist.bulk_write(
+                [
+                    UpdateOne(
+                        {
+                            "guild_id": guild_id,
+                            "user_id": user_id,
+                            "filters.regex": regex,
+                        },
+                        {"$inc": {"filters.$.matches": count}},
+                    )
+                    for (guild_id, user_id, regex), count in matches.items()
+                ],
+                ordered=False,
+            )
+        except Exception:
+            # keep the counts so they're written on the next flush
+            for key, count in matches.items():
+                self.matches[key] = self.matches.get(key, 0) + count
+            raise
+
+    async def forward(self, forward: dict):
+        """Send queued watchlist messages as one webhook message, errors are reported instead of raised."""
+        try:
+            await self.bot.webhooks.send(
+                channel=forward["channel"],
+                thread=forward["thread"],
+                content=", ".join(forward["mentions"]),
+                username=forward["username"],
+                avatar_url=forward["avatar_url"],
+                files=forward["files"],
+                embeds=forward["embeds"],
+            )
+        except Exception as e:
+            await self.bot.on_event_error(e, "watchlist_forward")
 
     async def initialize(self):
         """Cache all the existing webhook users."""
@@ -107,28 +258,86 @@ class Watchlist:
                 continue
 
             self.watchlist_data[guild.id] = {}
+            self.matchers[guild.id] = {}
             users = db.watchlist.find({"guild_id": guild.id})
             for user in users:
                 self.watchlist_data[guild.id][user["user_id"]] = user
+                self.update_matcher(guild.id, user["user_id"])
+
+    def update_matcher(self, guild_id: int, user_id: int):
+        """Rebuild the :class:`WatchlistMatcher` of a watchlist member from their filters."""
+        user_watchlist_data = self.watchlist_data[guild_id].get(user_id)
+        if user_watchlist_data is None:
+            self.matchers[guild_id].pop(user_id, None)
+        else:
+            self.matchers[guild_id][user_id] = WatchlistMatcher(
+                user_watchlist_data["filters"]
+            )
+
+    async def forget_channel(
+        self,
+        channel: discord.abc.GuildChannel,
+        after: discord.abc.GuildChannel = None,
+    ):
+        """
+        Remove a deleted or updated channel or thread from the resolved channels and threads.
+        If it's the watchlist category or one of its channels, everything resolved in the guild is removed.
+        """
+        for key, cached in list(self.channels.items()):
+            if cached.id == channel.id:
+                self.channels = {
+                    k: c for k, c in self.channels.items() if k[0] != key[0]
+                }
+                self.threads = {k: t for k, t in self.threads.items() if k[0] != key[0]}
+                return
+
+        for key, cached in list(self.threads.items()):
+            if cached.id == channel.id:
+                del self.threads[key]
 
-    @staticmethod
     async def get_generic_channel(
+        self,
         category: discord.CategoryChannel,
     ) -> Optional[discord.TextChannel]:
+        key = (category.guild.id, "generic")
+        if key in self.channels:
+            return self.channels[key]
+
         channel = discord.utils.get(category.channels, name="generic")
         if channel is None:
             channel = await category.create_text_channel("generic")
+        self.channels[key] = channel
         return channel
 
-    @staticmethod
     async def get_thread_channel(
+        self,
         category: discord.CategoryChannel,
     ) -> Optional[discord.TextChannel]:
+        key = (category.guild.id, "watchlist")
+        if key in self.channels:
+            return self.channels[key]
+
         channel = discord.utils.get(category.channels, name="watchlist")
         if channel is None:
             channel = await category.create_text_channel("watchlist")
+        self.channels[key] = channel
         return channel
 
+    async def get_member_thread(
+        self, guild: discord.Guild, user_watchlist_data: dict
+    ) -> Optional[discord.Thread]:
+        """Get the existing thread of a watchlist member."""
+        key = (guild.id, user_watchlist_data["user_id"])
+        if key in self.threads:
+            return self.threads[key]
+
+        category = await self.get_watchlist_category(guild)
+        watchlist_channel = await self.get_thread_channel(category)
+        thread = watchlist_channel.get_thread(user_watchlist_data.get("thread_id", 0))
+        if thread:
+            self.threads[key] = thread
+        return thread
+
     async def get_thread(
         self, channel: discord.TextChannel, member: discord.Member
     ) -> discord.Thread:
@@ -160,14 +369,18 @@ class Watchlist:
 
         return thread
 
-    @staticmethod
     async def get_watchlist_category(
+        self,
         guild: discord.Guild,
     ) -> Optional[discord.CategoryChannel]:
         """Get the watchlist category or create it if it doesn't exist."""
         if guild is None:
             return
 
+        key = (guild.id, "Watchlist")
+        if key in self.channels:
+            return self.channels[key]
+
         category = discord.utils.get(guild.categories, name="Watchlist")
         if category is None:
             # get all staff roles
@@ -186,6 +399,7 @@ class Watchlist:
                 name="Watchlist",  # overwrites=overwrites
             )
 
+        self.channels[key] = category
         return category
 
     async def get_member(
@@ -232,6 +446,7 @@ class Watchlist:
 
         db.watchlist.insert_one(watchlist_doc)
         self.watchlist_data[guild.id][member.id if member else 0] = watchlist_doc
+        self.update_matcher(guild.id, member.id if member else 0)
         return watchlist_doc
 
     async def remove_member(
@@ -244,10 +459,13 @@ class Watchlist:
         thread = watchlist_channel.get_thread(watchlist_member["thread_id"])
         if thread:
             await thread.archive()
+        self.threads.pop((guild.id, member.id if member else 0), None)
 
         db.watchlist.delete_one(
             {"guild_id": guild.id, "user_id": member.id if member else 0}
         )
+        self.watchlist_data[guild.id].pop(member.id if member else 0, None)
+        self.update_matcher(guild.id, member.id if member else 0)
 
     async def add_filters(
         self,
@@ -271,6 +489,7 @@ class Watchlist:
         self.watchlist_data[guild.id][member.id if member else 0][
             "filters"
         ] = filters_dict
+        self.update_matcher(guild.id, member.id if member else 0)
 
     async def remove_filters(
         self,
@@ -292,6 +511,7 @@ class Watchlist:
         self.watchlist_data[guild.id][member.id if member else 0][
             "filters"
         ] = new_filters
+        self.update_matcher(guild.id, member.id if member else 0)
 
     async def send_message(
         self,
@@ -302,9 +522,14 @@ class Watchlist:
         channel: discord.TextChannel = None,
         thread: discord.Thread = None,
     ):
-        """Send watchlist message with a webhook."""
-        # update stats first
-
+        """
+        Queue a watchlist message to be forwarded with a webhook.
+
+        Messages going to the same channel or thread are merged into one webhook message,
+        which is sent by :meth:`flush_forwards` or as soon as it can't fit more embeds or files.
+        Attachments are downloaded right away, so they're kept even if the message is deleted,
+        attachments too big to be uploaded are linked instead.
+        """
         if channel is None and thread is None:
             raise Exception("Both thread and channel is none")
 
@@ -312,49 +537,89 @@ class Watchlist:
             channel = thread.parent
 
         if matched_filter:
-            db.watchlist.update_one(
-                {
-                    "guild_id": message.guild.id,
-                    "filters": {"$elemMatch": {"regex": matched_filter["regex"]}},
-                },
-                {"$inc": {"filters.$.matches": 1}},
+            key = (
+                message.guild.id,
+                0 if generic else message.author.id,
+                matched_filter["regex"],
             )
+            self.matches[key] = self.matches.get(key, 0) + 1
+
+        files = []
+        files_size = 0
+        links = ""
+        for attachment in message.attachments:
+            if (
+                files_size + attachment.size > message.guild.filesize_limit
+                or len(files) >= self.max_files
+            ):
+                links += f"\n[{attachment.filename}]({attachment.url})"
+                continue
 
-        embeds = [
-            discord.Embed(
-                description=f"{message.content}\n{message.channel.mention} [link]({message.jump_url})",
-                timestamp=datetime.datetime.now(),
-            )
-        ]
+            try:
+                file = await attachment.to_file(use_cached=True)
+            except discord.HTTPException:
+                links += f"\n[{attachment.filename}]({attachment.url})"
+                continue
+
+            # messages are merged, so the names of their files need to be unique
+            file.filename = f"{message.id}_{attachment.filename}"
+            files.append((file, attachment))
+            files_size += attachment.size
+
+        embed = discord.Embed(
+            description=f"{message.content}\n{message.channel.mention} [link]({message.jump_url}){links}",
+            timestamp=datetime.datetime.now(),
+        )
+        image = next(
+            (
+                file
+                for file, attachment in files
+                if (attachment.content_type or "").startswith("image/")
+            ),
+            None,
+        )
+        if image:
+            embed.set_image(url=f"attachment://{image.filename}")
         if generic:
-            embeds[0].set_author(
+            embed.set_author(
                 name=str(message.author), icon_url=message.author.avatar_url
             )
 
-        files = [await attachment.to_file() for attachment in message.attachments]
-        content = (
-            f", ".join(
-                f"<@&{int(role_id)}>"
-                for role_id in (
-                    matched_filter["mention_roles"]
-                    if "mention_roles" in matched_filter
-                    else []
-                )
-            )
-            if matched_filter
-            else ""
-        )
-        await self.bot.webhooks.send(
-            channel=channel,
-            thread=thread,
-            content=content,
-            username=message.author.name if not generic else self.bot.user.name,
-            avatar_url=message.author.avatar
-            if not generic
-            else self.bot.user.avatar_url,
-            files=files,
-            embeds=embeds,
-        )
+        key = (channel.id, thread.id if thread else 0)
+        forward = self.forwards.get(key)
+        if forward and (
+            len(forward["embeds"]) >= self.max_embeds
+            or sum(len(e) for e in forward["embeds"]) + len(embed)
+            > self.max_embeds_length
+            or len(forward["files"]) + len(files) > self.max_files
+            or forward["files_size"] + files_size > message.guild.filesize_limit
+        ):
+            del self.forwards[key]
+            await self.forward(forward)
+            forward = None
+
+        if forward is None:
+            forward = self.forwards[key] = {
+                "channel": channel,
+                "thread": thread,
+                "username": message.author.name if not generic else self.bot.user.name,
+                "avatar_url": message.author.avatar
+                if not generic
+                else self.bot.user.avatar_url,
+                "embeds": [],
+                "mentions": [],
+                "files": [],
+                "files_size": 0,
+            }
+
+        forward["embeds"].append(embed)
+        forward["files"] += [file for file, _ in files]
+        forward["files_size"] += files_size
+        if matched_filter:
+            for role_id in matched_filter.get("mention_roles", []):
+                mention = f"<@&{int(role_id)}>"
+                if mention not in forward["mentions"]:
+                    forward["mentions"].append(mention)
 
     async def on_message(self, message: discord.Message):
         """Function run on every message to check if user is on watchlist and send their message."""
@@ -367,56 +632,48 @@ class Watchlist:
         if message.guild.id != config.MAIN_SERVER:
             return
 
-        ctx = await self.bot.get_context(message)
-        if ctx.command and (
-            ctx.command.name == "watchlist"
-            or (ctx.command.parent and ctx.command.parent.name == "watchlist")
-        ):
-            return
-
         if message.author.bot:
             return
 
-        if not message.guild:
+        guild_watchlist_data = self.watchlist_data.get(message.guild.id, {})
+        user_watchlist_data = guild_watchlist_data.get(message.author.id, {})
+        guild_matchers = self.matchers.get(message.guild.id, {})
+        generic_matcher = guild_matchers.get(0)
+        # users who aren't on the watchlist only need to be checked when there are generic filters
+        if not user_watchlist_data and (
+            generic_matcher is None or not generic_matcher.filters
+        ):
             return
 
-        guild_watchlist_data = self.watchlist_data[message.guild.id]
-        user_watchlist_data = guild_watchlist_data.get(message.author.id, {})
-        generic_watchlist_data = guild_watchlist_data.get(0, {})
+        if message.content.startswith(config.PREFIX):
+            ctx = await self.bot.get_context(message)
+            if ctx.command and (
+                ctx.command.name == "watchlist"
+                or (ctx.command.parent and ctx.command.parent.name == "watchlist")
+            ):
+                return
+
         watchlist_category = await self.get_watchlist_category(message.guild)
         if not watchlist_category:
             return
 
-        user_filters = user_watchlist_data.get("filters", [])
-        generic_filters = generic_watchlist_data.get("filters", [])
+        if generic_matcher is not None and generic_matcher.filters:
+            channel = await self.get_generic_channel(watchlist_category)
+            filter = generic_matcher.match(message.content)
+            if filter:
+                return await self.send_message(message, filter, True, channel=channel)
 
-        if generic_filters:
-            category = self.get_watchlist_category(
-                self.bot.get_guild(config.MAIN_SERVER)
-            )
-            channel = await self.get_generic_channel(category)
-            for filter in generic_filters:
-                if re.findall(filter["regex"], message.content, re.IGNORECASE):
-                    return await self.send_message(
-                        message, filter, True, channel=channel
-                    )
+        if not user_watchlist_data:
+            return
 
-        thread_id = user_watchlist_data.get("thread_id", "0")
-        category = await self.get_watchlist_category(message.guild)
-        watchlist_channel = await self.get_thread_channel(category)
-        thread = watchlist_channel.get_thread(thread_id)
+        thread = await self.get_member_thread(message.guild, user_watchlist_data)
         if thread:
-            matched_filter = None
-            if user_filters:
-                for filter in user_filters:
-                    if re.findall(filter["regex"], message.content, re.IGNORECASE):
-                        matched_filter = filter
-                        break
-            await self.send_message(
-                message, matched_filter, channel=watchlist_channel, thread=thread
-            )
+            matched_filter = guild_matchers[message.author.id].match(message.content)
+            await self.send_message(message, matched_filter, thread=thread)
         else:
             # remove from watchlist, since watchlist channel doesnt exist
             db.watchlist.delete_one(
                 {"guild_id": message.guild.id, "user_id": message.author.id}
             )
+            del guild_watchlist_data[message.author.id]
+            self.update_matcher(message.guild.id, message.author.id)